@@ -0,0 +1,210 @@
+"""Benchmarks for pytest-shell on a local bash.
+
+Run from the repository root::
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --compare results.json
+
+Each benchmark is run a number of times and the minimum, median and maximum
+are recorded, in seconds. Results are written as JSON so runs (e.g. before
+and after a change) can be compared with --compare.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from pytest_shell.fs import create_files  # noqa: E402
+from pytest_shell.shell import bash  # noqa: E402
+
+#: Output sizes for the throughput benchmark, in bytes
+SIZES = [1 << 10, 1 << 16, 1 << 20, 10 << 20, 100 << 20]
+
+
+def measure(func, repeat):
+    """Call func repeat times.
+
+    :return: Min, median and max time taken.
+    :rtype: dict
+    """
+    times = []
+    for _ in range(repeat):
+        started_at = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - started_at)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'max': times[-1], 'runs': repeat}
+
+
+def bench_startup(repeat):
+    def run():
+        with bash():
+            pass
+    return {'startup': measure(run, repeat)}
+
+
+def bench_round_trip(session, repeat):
+    def run():
+        for _ in range(100):
+            session.send('')
+    result = measure(run, repeat)
+    # Per command rather than per hundred
+    for key in ('min', 'median', 'max'):
+        result[key] /= 100
+    return {'round_trip': result}
+
+
+def bench_throughput(session, repeat, max_size):
+    results = {}
+    for size in SIZES:
+        if size > max_size:
+            break
+        # Lines of 99 characters, like text output
+        command = "head -c %d /dev/zero | tr '\\0' a | fold -w 99" % size
+        result = measure(lambda: session.connection.send(
+            command, remember=False, timeout=60.0), repeat)
+        result['bytes'] = size
+        result['bytes_per_second'] = size / result['median']
+        results['throughput_%d' % size] = result
+    return results
+
+
+def bench_helpers(session, repeat):
+    """Time the helpers as they're usually used (envvars cached,
+    path_exists() answered locally) and, as *_cold, going to the shell each
+    time like they did before those shortcuts, so they can be compared with
+    older results.
+    """
+    def envvars_cold():
+        # As if a command that might have changed them had been sent
+        session.connection.generation += 1
+        return session.envvars
+
+    def path_exists_cold():
+        local_fs, session.local_fs = session.local_fs, False
+        try:
+            return session.path_exists('/tmp')
+        finally:
+            session.local_fs = local_fs
+
+    # Fill the caches, so the warm cases only time hits
+    session.envvars
+    session.path_exists('/tmp')
+    return {
+        'envvars': measure(lambda: session.envvars, repeat),
+        'envvars_cold': measure(envvars_cold, repeat),
+        'path_exists': measure(lambda: session.path_exists('/tmp'), repeat),
+        'path_exists_cold': measure(path_exists_cold, repeat),
+    }
+
+
+def bench_subshell(session, repeat):
+    def run():
+        with session():
+            pass
+    return {'subshell': measure(run, repeat)}
+
+
+def bench_create_files(repeat, count):
+    structure = []
+    for i in range(count):
+        structure.append('dir%d/sub' % (i // 100))
+        structure.append({'dir%d/sub/file%d.txt' % (i // 100, i): {
+            'content': 'file %d\n' % i, 'mode': 0o644}})
+    tmp = tempfile.mkdtemp()
+
+    def run():
+        root = tempfile.mkdtemp(dir=tmp)
+        create_files(structure, root)
+
+    try:
+        result = measure(run, repeat)
+    finally:
+        shutil.rmtree(tmp)
+    result['files'] = count
+    return {'create_files': result}
+
+
+def run_all(args):
+    results = {}
+    results.update(bench_startup(args.repeat))
+    with bash() as session:
+        results.update(bench_round_trip(session, args.repeat))
+        results.update(bench_throughput(session, args.repeat,
+                                        args.max_size << 20))
+        results.update(bench_helpers(session, args.repeat))
+        results.update(bench_subshell(session, args.repeat))
+    results.update(bench_create_files(args.repeat, args.files))
+    return results
+
+
+def bash_version():
+    return subprocess.check_output(
+        ['/bin/bash', '-c', 'echo $BASH_VERSION']).decode().strip()
+
+
+def compare(old, new):
+    """Print how each benchmark changed between two sets of results.
+
+    Results from before the *_cold cases were added timed what they do, so
+    those are compared against the plain case.
+    """
+    print('%-22s %12s %12s %8s' % ('benchmark', 'old', 'new', 'speedup'))
+    for name in sorted(new):
+        old_name = name
+        if name not in old and name.endswith('_cold'):
+            old_name = name[:-len('_cold')]
+        if old_name not in old:
+            continue
+        before = old[old_name]['median']
+        after = new[name]['median']
+        print('%-22s %11.4fs %11.4fs %7.2fx' % (
+            name, before, after, before / after if after else float('inf')))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', '-o',
+                        help='File to write results to (default stdout).')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='Earlier results to compare against.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times to run each benchmark.')
+    parser.add_argument('--max-size', type=int, default=100,
+                        help='Largest output for the throughput benchmark, '
+                             'in MB.')
+    parser.add_argument('--files', type=int, default=2000,
+                        help='Number of files for create_files.')
+    args = parser.parse_args(argv)
+
+    results = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'bash': bash_version(),
+        'results': run_all(args),
+    }
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+    elif not args.compare:
+        print(data)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f)['results'], results['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,249 @@
 import pytest
 
 
+def pytest_addoption(parser):
+    group = parser.getgroup('shell')
+    group.addoption(
+        '--shell-pool-size', action='store', type=int, default=None,
+        dest='shell_pool_size',
+        help='Number of started shells to keep and reuse between tests '
+             '(0 to start a new shell for every test).')
+    parser.addini(
+        'shell_pool_size', default='0',
+        help='Number of started shells to keep and reuse between tests.')
+    group.addoption(
+        '--shell-zygote', action='store_true', default=None,
+        dest='shell_zygote',
+        help='Start shells by forking one that has already sourced the '
+             'files in the shell_zygote_source ini option.')
+    parser.addini(
+        'shell_zygote', type='bool', default=False,
+        help='Start shells by forking one that has already been set up.')
+    parser.addini(
+        'shell_zygote_source', type='pathlist',
+        help='Files to source in the shell that other shells are forked '
+             'from (see shell_zygote).')
+    parser.addini(
+        'shell_transcript_max_entries', default='',
+        help='Maximum number of command results to keep in memory for each '
+             'shell (older ones are written to a temporary file).')
+    parser.addini(
+        'shell_transcript_max_bytes', default='',
+        help='Maximum total size of command results to keep in memory for '
+             'each shell.')
+    group.addoption(
+        '--shell-durations', action='store', type=int, default=None,
+        dest='shell_durations', metavar='N',
+        help='Show the N slowest shell commands (N=0 for all).')
+
+
+def _is_xdist_worker(config):
+    return hasattr(config, 'workerinput')
+
+
+def _is_xdist_controller(config):
+    return (not _is_xdist_worker(config) and
+            getattr(config.option, 'dist', 'no') != 'no')
+
+
+def pytest_configure(config):
+    from pytest_shell.connection import LocalConnection
+    from pytest_shell.reaper import LeakedProcesses
+    leaks = config._shell_leaks = LeakedProcesses()
+    LocalConnection.leak_sink = leaks
+    count = config.getoption('shell_durations')
+    if count is not None:
+        from pytest_shell.durations import CommandDurations
+        durations = config._shell_durations = CommandDurations(
+            count or float('inf'))
+        LocalConnection.timings_sink = durations
+    zygote = None
+    if _use_zygote(config) and not _is_xdist_controller(config):
+        from pytest_shell.zygote import Zygote
+        # Started by the first shell that's needed
+        source = [str(path) for path in config.getini('shell_zygote_source')]
+        zygote = config._shell_zygote = Zygote(source=source)
+    size = _pool_size(config)
+    if not size:
+        return
+    if _is_xdist_controller(config):
+        # Tests run on the workers, which send their pool stats back
+        config._shell_pool_stats = {}
+        config._shell_pool_workers = 0
+        return
+    from functools import partial
+    from pytest_shell.pool import ShellPool
+    # Started now so the shells are ready by the time collection finishes
+    pool = config._shell_pool = ShellPool(size, partial(_new_session, config,
+                                                        zygote))
+    pool.warm()
+
+
+def pytest_sessionfinish(session):
+    config = session.config
+    pool = getattr(config, '_shell_pool', None)
+    if pool is not None:
+        pool.close()
+    zygote = getattr(config, '_shell_zygote', None)
+    if zygote is not None:
+        zygote.close()
+    if not _is_xdist_worker(config):
+        return
+    output = {'leaks': config._shell_leaks.entries}
+    if pool is not None:
+        output['pool'] = pool.counters()
+    durations = getattr(config, '_shell_durations', None)
+    if durations is not None:
+        output['durations'] = durations.slowest()
+    config.workeroutput['pytest_shell'] = output
+
+
+@pytest.hookimpl(optionalhook=True)
+def pytest_testnodedown(node, error):
+    """Merge stats from an xdist worker into the controller's."""
+    output = getattr(node, 'workeroutput', {}).get('pytest_shell')
+    if not output:
+        return
+    config = node.config
+    config._shell_leaks.merge(output.get('leaks', []))
+    if 'pool' in output and hasattr(config, '_shell_pool_stats'):
+        from pytest_shell.pool import merge_counters
+        merge_counters(config._shell_pool_stats, output['pool'])
+        config._shell_pool_workers += 1
+    durations = getattr(config, '_shell_durations', None)
+    if 'durations' in output and durations is not None:
+        durations.merge(output['durations'])
+
+
+def pytest_unconfigure(config):
+    from pytest_shell.connection import LocalConnection
+    LocalConnection.leak_sink = None
+    if getattr(config, '_shell_durations', None) is not None:
+        LocalConnection.timings_sink = None
+
+
+@pytest.hookimpl(hookwrapper=True)
+def pytest_runtest_protocol(item):
+    # So anything recorded can be put down to the test
+    sinks = [sink for sink in (getattr(item.config, '_shell_durations', None),
+                               getattr(item.config, '_shell_leaks', None))
+             if sink is not None]
+    for sink in sinks:
+        sink.nodeid = item.nodeid
+    try:
+        yield
+    finally:
+        for sink in sinks:
+            sink.nodeid = None
+
+
+def _pool_size(config):
+    size = config.getoption('shell_pool_size')
+    if size is None:
+        size = int(config.getini('shell_pool_size') or 0)
+    return size
+
+
+def _use_zygote(config):
+    use = config.getoption('shell_zygote')
+    if use is None:
+        use = config.getini('shell_zygote')
+    return use
+
+
+def _new_session(config, zygote=None):
+    """A session set up as the ini file says, not yet started."""
+    from pytest_shell.shell import LocalBashSession
+    return LocalBashSession(zygote=zygote, transcript=_transcript(config))
+
+
+def _transcript(config):
+    """A Transcript with the retention limits from the ini file, or None
+    for the default.
+    """
+    limits = [config.getini(name) for name in (
+        'shell_transcript_max_entries', 'shell_transcript_max_bytes')]
+    if not any(limits):
+        return None
+    from pytest_shell.transcript import Transcript
+    return Transcript(*[int(limit) if limit else None for limit in limits])
+
+
+@pytest.fixture(scope='session')
+def shell_zygote(request):
+    """Shell that the bash fixture's shells are forked from, or None if
+    disabled.
+
+    :rtype: pytest_shell.zygote.Zygote
+    """
+    return getattr(request.config, '_shell_zygote', None)
+
+
+@pytest.fixture(scope='session')
+def shell_pool(request):
+    """Pool of shells shared by the whole session (or xdist worker), or None
+    if disabled.
+    """
+    return getattr(request.config, '_shell_pool', None)
+
+
+@pytest.fixture(scope='session')
+def fs_templates(request):
+    """Cache of structures for create_files(), kept in the pytest cache
+    directory so they're only built once.
+
+    :rtype: pytest_shell.fs.TemplateCache
+    """
+    from pytest_shell.fs import TemplateCache
+    cache = getattr(request.config, 'cache', None)
+    templates = TemplateCache(
+        cache.makedir('pytest_shell_templates') if cache is not None
+        else None)
+    yield templates
+    templates.close()
+
+
 @pytest.fixture(name='bash')
-def bash_fixture(request):
-    from pytest_shell.shell import bash
-    with bash() as b:
+def bash_fixture(request, shell_pool, shell_zygote):
+    if shell_pool is None:
+        with _new_session(request.config, shell_zygote) as b:
+            yield b
+        return
+    b = shell_pool.checkout()
+    try:
         yield b
+    finally:
+        shell_pool.checkin(b)
+
+
+def pytest_terminal_summary(terminalreporter):
+    leaks = getattr(terminalreporter.config, '_shell_leaks', None)
+    if leaks is not None and leaks.entries:
+        terminalreporter.write_sep(
+            '=', 'shell processes left running (killed)', yellow=True)
+        for line in leaks.lines():
+            terminalreporter.write_line(line)
+    durations = getattr(terminalreporter.config, '_shell_durations', None)
+    if durations is not None:
+        if durations.count == float('inf'):
+            terminalreporter.write_sep('=', 'shell command durations')
+        else:
+            terminalreporter.write_sep(
+                '=', 'slowest %d shell commands' % durations.count)
+        for line in durations.lines():
+            terminalreporter.write_line(line)
+    config = terminalreporter.config
+    pool = getattr(config, '_shell_pool', None)
+    if pool is not None:
+        terminalreporter.write_sep('-', 'shell pool (size %d)' % pool.size)
+        lines = pool.stats()
+    elif getattr(config, '_shell_pool_workers', 0):
+        from pytest_shell.pool import format_stats
+        terminalreporter.write_sep(
+            '-', 'shell pools (size %d, %d workers)' % (
+                _pool_size(config), config._shell_pool_workers))
+        lines = format_stats(config._shell_pool_stats)
+    else:
+        return
+    for line in lines:
+        terminalreporter.write_line(line)
@@ -0,0 +1,394 @@
+"""asyncio versions of the connection and session classes, so that many
+processes can be driven at once from a single thread.
+
+Requires Python 3.5 or later.
+"""
+from __future__ import print_function
+
+import asyncio
+import codecs
+import copy
+import io
+import locale
+import logging
+import re
+import time
+
+import pytest
+
+from pytest_shell import reaper
+from pytest_shell.connection import (ExpectResult, LocalConnection,
+                                     OutputCollector, TimeOutError,
+                                     bash_command_terminator,
+                                     bash_ready_check)
+from pytest_shell.dialect import BashDialect
+from pytest_shell.matching import ExpectMatcher
+from pytest_shell.transcript import CommandRecord, Transcript, TranscriptView
+
+
+def async_local_bash_connection(cmd='/bin/bash', **kwargs):
+    kwargs.setdefault('ready', bash_ready_check)
+    return AsyncLocalConnection(cmd, bash_command_terminator, **kwargs)
+
+
+class AsyncLocalConnection(object):
+    """Like pytest_shell.connection.LocalConnection, but the process is run
+    with asyncio and anything that waits on it is a coroutine.
+    """
+
+    def __init__(self, command, terminator, encoding=None, transcript=None,
+                 ready=None):
+        """A connection to a local (subprocess) command.
+
+        :param command: Command to run on this connection, as a string or a
+            list of arguments.
+        :param callable terminator: See LocalConnection.
+        :param str encoding: Encoding used to talk to the process.
+        :param Transcript transcript: See LocalConnection.
+        :param callable ready: See LocalConnection.
+        """
+        self.command = command
+        self.ready = ready
+        self.process = None
+        self.terminator = terminator
+        self.transcript = transcript if transcript is not None else Transcript()
+        self.output = TranscriptView(self.transcript, 'stdout',
+                                     remembered_only=True)
+        self.debug_output = TranscriptView(self.transcript, 'stdout')
+        self.stderr_output = TranscriptView(self.transcript, 'stderr')
+        self.last_stderr = ''
+        self.last_return_code = None
+        self.leaked = []
+        self.encoding = encoding or locale.getpreferredencoding(False)
+        self._leftovers = {'out': '', 'err': ''}
+        self._reads = {}
+        self._decoders = {}
+        self.logger = logging.getLogger(__name__)
+
+    @property
+    def running(self):
+        return self.process is not None
+
+    @property
+    def last(self):
+        record = self.transcript.last_remembered
+        return record.stdout if record is not None else ''
+
+    async def start(self, timeout=10.0):
+        """Start the process and wait for it to be ready, see
+        LocalConnection.start().
+        """
+        command = self.command
+        if isinstance(command, str):
+            command = [command]
+        self.process = await asyncio.create_subprocess_exec(
+            *command, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True)
+        self._reads = {'s': None, 'e': None}
+        self._decoders = {
+            source: codecs.getincrementaldecoder(self.encoding)()
+            for source in self._reads}
+        if self.ready is None:
+            await asyncio.sleep(LocalConnection.startup_delay)
+            # Throw away whatever it printed
+            while any(await self._read_some(0)):
+                pass
+        else:
+            buf = io.BytesIO()
+            done_func = self.ready(buf, self.encoding)
+            await self._write(buf.getvalue())
+            await self._read(timeout=timeout, done_func=done_func,
+                             soft_timeout=False)
+        self._leftovers = {'out': '', 'err': ''}
+
+    async def finish(self):
+        """Clean up and end the process, and anything it left running, see
+        LocalConnection.finish().
+        """
+        try:
+            await self._send('exit')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        for task in self._reads.values():
+            if task is not None:
+                task.cancel()
+        try:
+            await asyncio.wait_for(self.process.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+        # See LocalConnection.finish()
+        self.leaked = await asyncio.get_event_loop().run_in_executor(
+            None, reaper.kill_session, self.process.pid, 0.5)
+        await self.process.wait()
+        if self.leaked and LocalConnection.leak_sink is not None:
+            LocalConnection.leak_sink(self.command, self.leaked)
+        return self.leaked
+
+    async def send(self, text, remember=True, timeout=10.0):
+        started_at = time.time()
+        self._leftovers = {'out': '', 'err': ''}
+        # The command and its terminator go out in one write
+        buf = io.BytesIO()
+        buf.write((text + '\n').encode(self.encoding))
+        check_done, get_output = self.terminator(buf, self.encoding)
+        self.logger.info('In: %s', repr(text))
+        await self._write(buf.getvalue())
+        out, stderr = await self._read(timeout=timeout, done_func=check_done)
+        out, self.last_return_code = get_output(out)
+        self.last_stderr = stderr
+        self.transcript.append(CommandRecord(
+            text, out, stderr, self.last_return_code,
+            {'total': time.time() - started_at}, remember))
+        return out
+
+    async def send_nowait(self, text, remember=True):
+        await self._send(text)
+
+    async def send_raw(self, text):
+        cmd = text + '\n'
+        self.logger.info('In raw: %s', repr(cmd))
+        await self._write(cmd.encode(self.encoding))
+
+    async def _send(self, text):
+        self.logger.info('In: %s', repr(text))
+        await self._write((text + '\n').encode(self.encoding))
+
+    async def _write(self, data):
+        self.process.stdin.write(data)
+        await self.process.stdin.drain()
+
+    def _streams(self):
+        return {'s': self.process.stdout, 'e': self.process.stderr}
+
+    async def _read(self, timeout=10.0, done_func=None, soft_timeout=True,
+                    drain=True):
+        """Read from stdout and stderr until done_func is satisfied, see
+        LocalConnection._read().
+
+        :raises TimeOutError:
+        :return: Output and stderr.
+        :rtype: (str, str)
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        collector = OutputCollector(done_func, logger=self.logger)
+        reading = not collector.feed(self._leftovers['out'],
+                                     self._leftovers['err'])
+        while reading:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                self.logger.info('Timed out')
+                raise TimeOutError()
+            read_out, read_err = await self._read_some(remaining)
+            if read_out or read_err:
+                if soft_timeout:
+                    deadline = loop.time() + timeout
+                reading = not collector.feed(read_out, read_err)
+        self._leftovers = collector.leftovers
+        out, stderr = collector.out, collector.stderr
+        while drain:
+            read_out, read_err = await self._read_some(0)
+            out += read_err + read_out
+            stderr += read_err
+            drain = bool(read_out or read_err)
+        return out, stderr.rstrip('\n')
+
+    async def _read_some(self, timeout):
+        """Wait up to timeout for either stream to have some output.
+
+        :return: Text read from stdout and stderr.
+        :rtype: (str, str)
+        """
+        streams = self._streams()
+        for source, task in self._reads.items():
+            if task is None and not streams[source].at_eof():
+                self._reads[source] = asyncio.ensure_future(
+                    streams[source].read(65536))
+        pending = [task for task in self._reads.values() if task is not None]
+        if not pending:
+            # Nothing more is coming, let the caller time out
+            await asyncio.sleep(timeout)
+            return '', ''
+        done, _ = await asyncio.wait(pending, timeout=timeout,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        text = {'s': '', 'e': ''}
+        for source, task in self._reads.items():
+            if task in done:
+                self._reads[source] = None
+                text[source] = self._decoders[source].decode(task.result())
+        return text['s'], text['e']
+
+    async def wait_for(self, pattern_or_function, timeout=3.0):
+        self.logger.debug('waiting for %s', pattern_or_function)
+        if not (callable(pattern_or_function) or
+                hasattr(pattern_or_function, 'search')):
+            pattern_or_function = re.compile(pattern_or_function, re.M)
+        r = await self._read(timeout=timeout, done_func=pattern_or_function)
+        return r[0]
+
+    async def expect(self, patterns, timeout=3.0):
+        """See LocalConnection.expect()."""
+        patterns = [p if hasattr(p, 'search') else re.compile(p, re.M)
+                    for p in patterns]
+        matcher = ExpectMatcher(patterns)
+        out = (await self._read(timeout=timeout, done_func=matcher,
+                                drain=False))[0]
+        match = matcher.match
+        before = out[:len(out) - len(match.group(0))]
+        return ExpectResult(matcher.index, match, before,
+                            self._leftovers['err'] + self._leftovers['out'])
+
+
+class AsyncShellSession(object):
+    """asyncio version of pytest_shell.shell.ShellSession.
+
+    Used as an async context manager, and any method that talks to the shell
+    is a coroutine (including envvars, which is awaited like
+    ``await session.envvars``). Commands are put together and output parsed
+    by the dialect class, so behaviour matches the synchronous session.
+    """
+
+    dialect = BashDialect
+
+    def __init__(self, connection, envvars=None, source=None, pwd=None):
+        self._initial_envvars = dict(envvars) if envvars else {}
+        self._initial_source = list(source) if source else []
+        self._initial_pwd = pwd
+        self._depth = 0
+        self.connection = connection
+        self.auto_return_code_error = True
+        self.last_return_code = 0
+
+    def __call__(self, envvars=None, source=None, pwd=None):
+        obj = copy.copy(self)
+        obj._initial_envvars = dict(envvars) if envvars else {}
+        obj._initial_source = list(source) if source else []
+        obj._initial_pwd = pwd
+        obj._depth = self._depth + 1
+        return obj
+
+    async def __aenter__(self):
+        if self._depth > 0:
+            await self.start_subshell()
+        else:
+            await self.connection.start()
+        commands = self.dialect.bootstrap_commands(
+            self._initial_pwd, self._initial_envvars, self._initial_source)
+        if commands:
+            out = await self.connection.send(
+                self.dialect.bootstrap_command(commands), remember=False)
+            failures = self.dialect.parse_bootstrap(commands, out)
+            if failures and self.auto_return_code_error:
+                for command, rc, out in failures:
+                    print('Command:', command)
+                    print('output:', out)
+                await self.__aexit__(None, None, None)
+                pytest.fail(
+                    'Got non-zero return codes setting up the shell: %s' %
+                    ', '.join('"%s" (%d)' % (command, rc)
+                              for command, rc, _ in failures))
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._depth == 0:
+            await self.connection.finish()
+        else:
+            await self.exit()
+
+    def _check(self, out, what, label='Command'):
+        self.last_return_code = self.connection.last_return_code or 0
+        if self.last_return_code and self.auto_return_code_error:
+            print('%s:' % label, what)
+            print('stdout:', out)
+            print('stderr:', self.connection.last_stderr)
+            pytest.fail('Got non-zero return code %d when running "%s"' %
+                        (self.last_return_code, what))
+        return out
+
+    async def send(self, command):
+        out = await self.connection.send(command)
+        return self._check(out, command)
+
+    async def send_raw(self, command):
+        await self.connection.send_raw(command)
+
+    async def send_nowait(self, command):
+        await self.connection.send_nowait(command)
+
+    async def wait_for(self, pattern_or_function, timeout=3.0):
+        return await self.connection.wait_for(pattern_or_function, timeout)
+
+    async def expect(self, patterns, timeout=3.0):
+        return await self.connection.expect(patterns, timeout)
+
+    async def run_script(self, path, args=None):
+        out = await self.connection.send(
+            self.dialect.run_script_command(path, args))
+        return self._check(out, path, 'Script')
+
+    async def run_script_inline(self, lines):
+        out = []
+        for l in lines:
+            out.append(await self.connection.send(l, timeout=1000.0))
+        return self._check('\n'.join(out), lines, 'Script')
+
+    @property
+    def envvars(self):
+        return self._envvars()
+
+    async def _envvars(self):
+        return self.dialect.parse_envvars(await self.connection.send(
+            self.dialect.envvars_command(), remember=False))
+
+    async def path_exists(self, path):
+        await self.connection.send(self.dialect.path_exists_command(path),
+                                   remember=False)
+        return self.dialect.parse_path_exists(self.connection.last_stderr)
+
+    async def file_contents(self, path):
+        if await self.path_exists(path):
+            return await self.connection.send(
+                self.dialect.file_contents_command(path), remember=False)
+
+    async def paths_exist(self, paths):
+        return self.dialect.parse_paths_exist(await self.connection.send(
+            self.dialect.paths_exist_command(paths), remember=False))
+
+    async def stat_many(self, paths):
+        return self.dialect.parse_stat_many(paths, await self.connection.send(
+            self.dialect.stat_many_command(paths), remember=False))
+
+    async def file_contents_many(self, paths, binary=False):
+        return self.dialect.parse_file_contents_many(
+            await self.connection.send(
+                self.dialect.file_contents_many_command(paths),
+                remember=False),
+            None if binary else self.connection.encoding)
+
+    async def set_env(self, name, value):
+        await self.connection.send(self.dialect.set_env_command(name, value),
+                                   remember=False)
+
+    async def source(self, fname):
+        await self.connection.send(self.dialect.source_command(fname),
+                                   remember=False)
+
+    async def cd(self, path):
+        await self.connection.send(self.dialect.cd_command(path))
+
+    async def start_subshell(self):
+        await self.connection.send(self.dialect.run_command(), remember=False)
+
+    async def exit(self):
+        await self.connection.send('exit')
+
+
+class AsyncLocalBashSession(AsyncShellSession):
+
+    def __init__(self, envvars=None, source=None, pwd=None, cmd='/bin/bash'):
+        AsyncShellSession.__init__(self, async_local_bash_connection(cmd=cmd),
+                                   envvars, source, pwd)
+
+
+async_bash = AsyncLocalBashSession
@@ -1,27 +1,66 @@
 from __future__ import unicode_literals
 
+import codecs
+import collections
+import select
 import subprocess
 import uuid
 import fcntl
+import io
 import os
-from collections import OrderedDict
 import re
+import signal
 import time
 import locale
 import logging
+import sys
+
+from pytest_shell import reaper
+from pytest_shell.framing import LineFramer
+from pytest_shell.matching import (ExpectMatcher, SubstringMatcher,
+                                   as_matcher)
+from pytest_shell.transcript import CommandRecord, Transcript, TranscriptView
 
 
 class TimeOutError(Exception): pass
 
 
-def local_bash_connection(cmd='/bin/bash'):
-    return LocalConnection(cmd, bash_command_terminator)
+#: Result of LocalConnection.expect(). index is the position in the list of
+#: the pattern that matched, before is the output up to the match and after
+#: is whatever had already been read after it.
+ExpectResult = collections.namedtuple('ExpectResult',
+                                      'index match before after')
+
+
+def local_bash_connection(cmd='/bin/bash', **kwargs):
+    kwargs.setdefault('ready', bash_ready_check)
+    return LocalConnection(cmd, bash_command_terminator, **kwargs)
 
 
 class LocalConnection(object):
     """Class representing a connection to a command executed using subprocess.
     """
-    def __init__(self, command, terminator, encoding=None):
+
+    #: Smallest and largest amounts read from the process in one go. The
+    #: size used for each stream grows while reads fill it and shrinks when
+    #: they don't.
+    min_read_size = 4096
+    max_read_size = 1 << 20
+
+    #: Called with the command and its timings after each command or wait,
+    #: if set. The plugin uses this for --shell-durations.
+    timings_sink = None
+
+    #: Called with the command run by the connection and the processes it
+    #: left running (see finish()), if set and there were any.
+    leak_sink = None
+
+    #: How long start() waits for a process without a ready check before
+    #: throwing away what it has printed.
+    startup_delay = 0.5
+
+    def __init__(self, command, terminator, encoding=None, transcript=None,
+                 errors='strict', ready=None):
         """A connection to a local (subprocess) command.
 
         :param str command: Command to run on this connection.
@@ -29,21 +68,48 @@ class LocalConnection(object):
             running command and returns a function that when called with all 
             currently read output of the command says whether the command is
             finished.
+        :param str encoding: Encoding used to talk to the process.
+        :param Transcript transcript: Where to keep the results of commands,
+            e.g. to limit how many are kept. Unlimited by default.
+        :param str errors: How to handle output that can't be decoded, as
+            for bytes.decode().
+        :param callable ready: A function that takes the stdin of the
+            process and the encoding, writes something that makes the
+            process show it's ready, and returns a matcher (see
+            pytest_shell.matching) for its output, e.g. bash_ready_check.
+            Without one, start() waits for startup_delay instead.
 
         ..todo:: This is getting a bit bash-specific.
         """
         self.command = command
+        self.ready = ready
         self.process = None
         self.parent_pipe = None
         self.child_pipe = None
         self.terminator = terminator
-        self.output = OrderedDict()
-        # FIXME: why the f are these dicts!?
-        self.debug_output = OrderedDict()
-        self.stderr_output = OrderedDict()
+        self.transcript = transcript if transcript is not None else Transcript()
+        # Views of the transcript by command
+        self.output = TranscriptView(self.transcript, 'stdout',
+                                     remembered_only=True)
+        self.debug_output = TranscriptView(self.transcript, 'stdout')
+        self.stderr_output = TranscriptView(self.transcript, 'stderr')
         self.last_stderr = ''
+        self.last_return_code = None
+        self.last_return_codes = []
+        self.last_timings = {}
+        #: Processes left running when the connection was finished, see
+        #: finish().
+        self.leaked = []
+        #: Incremented whenever a command that might change the shell's
+        #: state is sent, so anything cached about it can be checked.
+        self.generation = 0
         self.encoding = encoding or locale.getpreferredencoding(False)
+        self.errors = errors
         self._blocking = False
+        self._buffer = None
+        self._files = {}
+        self._read_sizes = {}
+        self._decoders = {}
         self._leftovers = {'out': '', 'err': ''}
         self.logger = logging.getLogger(__name__)
 
@@ -53,162 +119,667 @@ class LocalConnection(object):
 
     @property
     def last(self):
-        return list(self.output.values())[-1] if self.output else ''
+        record = self.transcript.last_remembered
+        return record.stdout if record is not None else ''
 
-    def start(self):
+    def start(self, timeout=10.0):
         """Set up the specified process and io handles.
+
+        With a ready check, returns once the process has echoed back a
+        marker, otherwise after startup_delay. Anything it printed before
+        that (rc files, motd etc.) is thrown away.
+
+        :param float timeout: Maximum time to wait for the process to be
+            ready.
+        :raises TimeOutError:
         """
-        p = self.process = subprocess.Popen(
-            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE, bufsize=0)
-        # Use non-blocking io
-        fcntl.fcntl(
-            p.stdout.fileno(), fcntl.F_SETFL, 
-            fcntl.fcntl(p.stdout.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
-        fcntl.fcntl(
-            p.stderr.fileno(), fcntl.F_SETFL,
-            fcntl.fcntl(p.stdout.fileno(), fcntl.F_GETFL) | os.O_NONBLOCK)
-        time.sleep(0.5)
+        self.generation += 1
+        p = self.process = self._spawn(timeout)
+        # Use non-blocking io, reading straight into one reusable buffer
+        self._buffer = bytearray(self.max_read_size)
+        for f in (p.stdout, p.stderr):
+            fd = f.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._files[fd] = io.FileIO(fd, closefd=False)
+            self._read_sizes[fd] = self.min_read_size
+        self._reset_decoders()
+        if self.ready is None:
+            # No way of asking, so give it a moment
+            time.sleep(self.startup_delay)
+        else:
+            buf = io.BytesIO()
+            done_func = self.ready(buf, self.encoding)
+            self.logger.info('In: %s', repr(buf.getvalue()))
+            p.stdin.write(buf.getvalue())
+            self._read(timeout=timeout, done_func=done_func,
+                       soft_timeout=False)
+        self._leftovers = {'out': '', 'err': ''}
         self.drain()
 
+    def _spawn(self, timeout):
+        """Start the process.
+
+        :param float timeout: Maximum time to wait for it to start.
+        :rtype: subprocess.Popen
+        """
+        # In its own session so anything it leaves running can be found
+        if sys.version_info >= (3, 2):
+            new_session = {'start_new_session': True}
+        else:  # pragma: no cover
+            new_session = {'preexec_fn': os.setsid}
+        return subprocess.Popen(
+            self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, bufsize=0, **new_session)
+
     def drain(self):
+        """Throw away anything currently waiting to be read."""
+        for fd in self._files:
+            while self._read_available(fd):
+                pass
+        self._reset_decoders()
+
+    def _reset_decoders(self):
+        self._decoders = {
+            source: codecs.getincrementaldecoder(self.encoding)(self.errors)
+            for source in ('out', 'err')}
+
+    def clear(self):
+        """Forget all output, e.g. before handing the connection to someone
+        else."""
+        self.drain()
+        self.transcript.clear()
+        self.last_stderr = ''
+        self.last_return_code = None
+        self.last_return_codes = []
+        self.last_timings = {}
+        self._leftovers = {'out': '', 'err': ''}
+
+    def finish(self, timeout=0.5):
+        """Clean up and end the process, and anything it left running.
+
+        The process is asked to exit, then it and everything else in its
+        session is sent SIGTERM, then SIGKILL, waiting up to timeout after
+        each.
+
+        :param float timeout: Maximum time to wait at each step.
+        :return: pid and command line of each process (other than the one
+            started by this connection) that was left running and killed.
+        :rtype: list[(int, str)]
+        """
+        p = self.process
         try:
-            os.read(self.process.stdout.fileno(), 1024)
-        except OSError:
-            pass
-        try:
-            os.read(self.process.stderr.fileno(), 1024)
-        except OSError:
+            p.stdin.write('exit\n'.encode(self.encoding))
+            p.stdin.close()
+        except (IOError, OSError, ValueError):
+            # Already gone
             pass
+        reaper.wait(p, timeout)
+        self.leaked = self._kill_leftovers(timeout)
+        p.wait()
+        for f in (p.stdout, p.stderr):
+            f.close()
+        self._files = {}
+        if self.leaked:
+            self.logger.warning('killed processes left running: %s',
+                                self.leaked)
+            if self.leak_sink is not None:
+                self.leak_sink(self.command, self.leaked)
+        return self.leaked
 
-    def finish(self):
-        """Clean up and end process."""
-        self.process.stdin.write('exit\n'.encode(self.encoding))
-        self.process.terminate()
+    def _kill_leftovers(self, timeout):
+        """Stop the process, if it's still running, and anything it left
+        running, see reaper.kill_session().
+        """
+        return reaper.kill_session(self.process.pid, timeout,
+                                   leader=self.process)
+
+    def send(self, text, remember=True, timeout=10.0, soft_timeout=True,
+             readonly=False):
+        """Send a command and wait for it to finish.
 
-    def send(self, text, remember=True, timeout=10.0):
+        :param str text: Command to run.
+        :param bool remember: Whether to remember the output.
+        :param float timeout: Maximum time to wait (but see soft_timeout).
+        :param bool soft_timeout: See _read().
+        :param bool readonly: The command doesn't change the shell's state,
+            so generation is left alone.
+        :return: Output of the command.
+        :rtype: str
+        """
+        started_at = time.time()
+        if not readonly:
+            self.generation += 1
         self._leftovers = {'out': '', 'err': ''}
         self._send(text)
         check_done, get_output = self.terminator(self.process.stdin,
                                                  self.encoding)
+        timings = {'write': time.time() - started_at}
         out, stderr = self._read(timeout=timeout, done_func=check_done,
-                                 extract_func=get_output)
-        if remember:
-            self.output[text] = out
-        self.debug_output[text] = out
-        self.stderr_output[text] = self.last_stderr = stderr
+                                 soft_timeout=soft_timeout, timings=timings)
+        out, self.last_return_code = get_output(out)
+        self.last_stderr = stderr
+        timings['total'] = time.time() - started_at
+        self.transcript.append(CommandRecord(
+            text, out, stderr, self.last_return_code, timings, remember))
+        self._timed(text, timings)
         return out
 
+    def send_many(self, texts, remember=True, timeout=10.0):
+        """Send several commands in a single write and read back the output
+        of each, as if each had been passed to send().
+
+        The commands are run one after another as usual, but without waiting
+        for each to finish before sending the next, so they shouldn't read
+        from stdin.
+
+        :param list[str] texts: Commands to run.
+        :param bool remember: Whether to remember the output.
+        :param float timeout: Timeout for each command.
+        :return: Output of each command. The return codes are stored in
+            last_return_codes.
+        :rtype: list[str]
+        """
+        texts = list(texts)
+        if not texts:
+            self.last_return_codes = []
+            return []
+        started_at = time.time()
+        self.generation += 1
+        self._leftovers = {'out': '', 'err': ''}
+        buf = io.BytesIO()
+        terminators = []
+        for text in texts:
+            cmd = (text + '\n').encode(self.encoding)
+            self.logger.info('In: %s', repr(cmd))
+            buf.write(cmd)
+            # The stderr marker lets us tell which command wrote what to
+            # stderr when they're running ahead of us.
+            terminators.append(self.terminator(buf, self.encoding,
+                                               stderr=True))
+        self.process.stdin.write(buf.getvalue())
+        timings = {'write': time.time() - started_at}
+        # Each line goes to whichever command its stream is up to, which moves
+        # on to the next command when that command's marker goes past.
+        outs = [[] for _ in texts]
+        stderrs = [[] for _ in texts]
+        position = {'s': 0, 'e': 0}
+
+        def collect(source, line):
+            i = position[source]
+            outs[i].append(line)
+            if source == 'e':
+                stderrs[i].append(line)
+            out, rc = terminators[i][1](line)
+            if (rc is not None if source == 's' else out != line):
+                position[source] = min(i + 1, len(texts) - 1)
+
+        self._read(timeout=timeout * len(texts), done_func=terminators[-1][0],
+                   drain=False, line_func=collect, timings=timings)
+        # There's no telling how long each took, just the batch
+        timings['total'] = time.time() - started_at
+        self.last_return_codes = []
+        for i, (text, (_, get_output)) in enumerate(zip(texts, terminators)):
+            outs[i], self.last_return_code = get_output(''.join(outs[i]))
+            self.last_stderr = get_output(
+                ''.join(stderrs[i]))[0].rstrip('\n')
+            self.transcript.append(CommandRecord(
+                text, outs[i], self.last_stderr, self.last_return_code,
+                timings, remember))
+            self.last_return_codes.append(self.last_return_code)
+        self._timed('; '.join(texts), timings)
+        return outs
+
+    def send_stream(self, text, timeout=10.0):
+        """Send a command and get its output a line at a time as it arrives,
+        rather than all at once when it finishes.
+
+        Nothing is kept in memory except the line being read, so this suits
+        long-running commands and those with a lot of output. The command
+        is finished once the returned stream has been exhausted or closed.
+
+        :param str text: Command to run.
+        :param float timeout: Maximum time to wait for each line.
+        :rtype: CommandStream
+        """
+        self.generation += 1
+        return CommandStream(self, text, timeout)
+
     def send_nowait(self, text, remember=True):
+        self.generation += 1
         self._send(text)
 
     def send_raw(self, text):
+        self.generation += 1
         cmd = text + '\n'
         self.logger.info('In raw: %s', repr(cmd))
         self.process.stdin.write(cmd.encode(self.encoding))
 
+    def interrupt(self, sig=signal.SIGINT):
+        """Stop the command the shell is running, as Ctrl-C would.
+
+        The signal goes to its foreground processes, not the shell itself or
+        background jobs, see reaper.foreground_processes(). Commands run by
+        the shell itself (e.g. a loop of builtins) can't be stopped this way.
+
+        :param int sig: Signal to send.
+        :return: pids that were sent it.
+        :rtype: list[int]
+        """
+        pids = reaper.foreground_processes(self.process.pid)
+        self.logger.info('Interrupting %s with %d', pids, sig)
+        reaper.send_signal(pids, sig)
+        return pids
+
     def _send(self, text, add_newline=True):
         cmd = (text + '\n' if add_newline else '').encode(self.encoding)
         self.logger.info('In: %s', repr(cmd))
         self.process.stdin.write(cmd)
 
-    def _read(self, timeout=10.0, done_func=None, extract_func=None, soft_timeout=True):
+    def _read(self, timeout=10.0, done_func=None, extract_func=None,
+              soft_timeout=True, drain=True, line_func=None, timings=None):
         """Read from stdin and stderr and return the result.
 
         :param float timeout: Maximum time to wait to read (but see soft_timeout).
-        :param callable done_func: A function called on the output to know if
-            we should stopr eading.
+        :param done_func: Matcher (see pytest_shell.matching), compiled regex
+            or function called on the output to know if we should stop
+            reading.
         :param callable extract_func: Optional function that takes the output,
             performs any required processing, and returns the output.
         :param bool soft_timeout: If True, the timeout is reset when data is
             read (e.g. x seconds of no data are required to timeout). If False,
             TimeOutError will be raised after timeout regardless of data
             being read.
+        :param bool drain: If True, anything else immediately available once
+            done_func is satisfied is added to the output rather than kept
+            for the next read.
+        :param callable line_func: Optional function called with the source
+            ('s' or 'e') and text of each complete line as it's added to the
+            output.
+        :param dict timings: If given, time spent waiting for the first
+            output, for done_func to be satisfied and draining, and the
+            number of bytes read, are added to it.
         :raises TimeOutError:
         :return: Output as string.
         :rtype: str
         """
-        out = ''
-        stderr = ''
-        fileno = self.process.stdout.fileno()
-        fileno_stderr = self.process.stderr.fileno()
-        started_at = time.time()
-        reading = True
+        poller = self._poller()
+        started_at = read_at = time.time()
+        first_byte_at = None
+        read_bytes = 0
+        # Anything left over from the last read is checked before waiting on
+        # the process again.
+        collector = OutputCollector(done_func, line_func, self.logger)
+        reading = not collector.feed(self._leftovers['out'],
+                                     self._leftovers['err'])
         while reading:
-            read_out = self._leftovers['out']
-            read_err = self._leftovers['err']
-            # TODO: should probably work with bytes until the end
-            try:
-                r = os.read(fileno_stderr, 1024).decode(self.encoding)
-                read_err += r
-                stderr += r
-            except OSError:
-                pass
-            try:
-                read_out += os.read(fileno, 1024).decode(self.encoding)
-            except OSError:
-                pass
-            self.logger.debug('Out: %s', read_out)
+            remaining = timeout - (time.time() - started_at)
+            if remaining <= 0:
+                self.logger.info('Timed out')
+                # TODO: should still handle any output
+                raise TimeOutError()
+            # Block until either stream has something for us (or hangs
+            # up) rather than polling on a fixed interval.
+            data_out, data_err = self._poll_read(poller, remaining)
+            if first_byte_at is None and (data_out or data_err):
+                first_byte_at = time.time()
+            read_bytes += len(data_out) + len(data_err)
+            read_out, read_err = self._decode(data_out, data_err)
+            self.logger.debug('Out: %r', read_out)
             if read_out or read_err:
                 if soft_timeout:
                     # reset the timer
                     started_at = time.time()
-                lines_out = read_out.splitlines(True)
-                lines_err = read_err.splitlines(True)
-                # This is pretty stupid
-                lines = [('e', l) for l in lines_err] + [('s', l) for l in lines_out]
-                while lines:
-                    (source, line) = lines.pop(0)
-                    out += line
-                    self.logger.debug('Checking against %s', repr(out))
-                    if done_func(out):
-                        self.logger.debug('Matched with output %s (%s remaining)',
-                                          out, repr(lines))
-                        reading = False
-                        # Keep everything after the line we matched for the
-                        # next go. It would probably be nicer to know where
-                        # the match happened and not worry about lines but
-                        # that requires relying on the pattern being a regex.
-                        # TODO: probably that
-                        # this is stupid too
-                        self._leftovers['out'] = ''.join([l for s, l in lines if s == 's'])
-                        self._leftovers['err'] = ''.join([l for s, l in lines if s == 'e'])
-                        break
-            else:
-                time.sleep(0.1)
-            if time.time() - started_at >= timeout:
-                self.logger.info('Timed out')
-                # TODO: should still handle any output
-                raise TimeOutError()
-        finished = False
-        while not finished:
-            try:
-                out += os.read(fileno, 1024).decode(self.encoding)
-                finished = False
-            except OSError:
-                finished = True
-            try:
-                out += os.read(fileno_stderr, 1024).decode(self.encoding)
-                finished = False
-            except OSError:
-                finished = finished and True
+                reading = not collector.feed(read_out, read_err)
+        matched_at = time.time()
+        self._leftovers = collector.leftovers
+        out, stderr = collector.out, collector.stderr
+        # Anything drained now would come after what's been left over
+        drain = drain and not any(self._leftovers.values())
+        while drain:
+            data_out = self._read_available(self.process.stdout.fileno())
+            data_err = self._read_available(self.process.stderr.fileno())
+            read_bytes += len(data_out) + len(data_err)
+            read_out, read_err = self._decode(data_out, data_err)
+            out += read_out + read_err
+            stderr += read_err
+            drain = bool(read_out or read_err)
+        if timings is not None:
+            # Leftovers from last time may have been enough
+            first_byte_at = first_byte_at or matched_at
+            timings['first_byte'] = first_byte_at - read_at
+            timings['terminator'] = matched_at - first_byte_at
+            timings['drain'] = time.time() - matched_at
+            timings['bytes'] = read_bytes
         if extract_func:
             out = extract_func(out)
         stderr = stderr.rstrip('\n')
         return out, stderr
 
+    def _timed(self, command, timings):
+        self.last_timings = timings
+        if self.timings_sink is not None:
+            self.timings_sink(command, timings)
+
+    def _poll_read(self, poller, timeout):
+        """Wait for output from the process and read it.
+
+        :param select.poll poller: Poller with the process's stdout and
+            stderr registered.
+        :param float timeout: Maximum time to wait.
+        :return: Data read from stdout and stderr.
+        :rtype: (bytes, bytes)
+        """
+        out = err = b''
+        for fd, event in poller.poll(timeout * 1000):
+            data = self._read_fd(fd)
+            if data is None:
+                continue
+            if not data:
+                # EOF, the process has gone away so stop watching this
+                # stream and let the caller's timeout take its course.
+                poller.unregister(fd)
+            elif fd == self.process.stderr.fileno():
+                err = data
+            else:
+                out = data
+        return out, err
+
+    def _read_fd(self, fd):
+        """Read what's available from one of the process's streams.
+
+        :return: Data read, empty at EOF, or None if there's nothing to read.
+        :rtype: bytes
+        """
+        size = self._read_sizes[fd]
+        try:
+            n = self._files[fd].readinto(memoryview(self._buffer)[:size])
+        except (OSError, IOError):
+            return None
+        if n is None:
+            return None
+        if n == size:
+            self._read_sizes[fd] = min(size * 2, self.max_read_size)
+        elif n < size // 4:
+            self._read_sizes[fd] = max(size // 2, self.min_read_size)
+        return memoryview(self._buffer)[:n].tobytes()
+
+    def _read_available(self, fd):
+        """Read from one of the process's streams without waiting.
+
+        :rtype: bytes
+        """
+        return self._read_fd(fd) or b''
+
+    def _decode(self, out, err):
+        """Decode data read from stdout and stderr.
+
+        :rtype: (str, str)
+        """
+        return (self._decoders['out'].decode(out) if out else '',
+                self._decoders['err'].decode(err) if err else '')
+
+    def _poller(self):
+        poller = select.poll()
+        poller.register(self.process.stdout.fileno(), select.POLLIN)
+        poller.register(self.process.stderr.fileno(), select.POLLIN)
+        return poller
+
     def wait_for(self, pattern_or_function, timeout=3.0):
         self.logger.debug('waiting for %s', pattern_or_function)
-        if not callable(pattern_or_function):
+        if not (callable(pattern_or_function) or
+                hasattr(pattern_or_function, 'search')):
             pattern_or_function = re.compile(pattern_or_function, re.M)
-        if hasattr(pattern_or_function, 'search'):
-            pattern = pattern_or_function
-            pattern_or_function = (lambda data: pattern.search(data) is not None)
-        r = self._read(timeout=timeout, done_func=pattern_or_function)[0]
+        started_at = time.time()
+        timings = {}
+        # Anything after the match is kept for the next read
+        r = self._read(timeout=timeout, done_func=pattern_or_function,
+                       drain=False, timings=timings)[0]
+        timings['total'] = time.time() - started_at
+        self._timed('wait_for(%r)' % getattr(pattern_or_function, 'pattern',
+                                             pattern_or_function), timings)
         return r
 
+    def expect(self, patterns, timeout=3.0):
+        """Wait for whichever of several patterns turns up first in the
+        output, e.g. a prompt or an error.
+
+        Output after the match is left to be read by the next call.
+
+        :param list patterns: Regular expressions, as strings (compiled with
+            re.M like wait_for()) or compiled.
+        :param float timeout: Maximum time to wait without any output.
+        :raises TimeOutError:
+        :rtype: ExpectResult
+        """
+        patterns = [p if hasattr(p, 'search') else re.compile(p, re.M)
+                    for p in patterns]
+        self.logger.debug('expecting %s', patterns)
+        matcher = ExpectMatcher(patterns)
+        started_at = time.time()
+        timings = {}
+        out = self._read(timeout=timeout, done_func=matcher, drain=False,
+                         timings=timings)[0]
+        timings['total'] = time.time() - started_at
+        self._timed('expect(%r)' % [p.pattern for p in patterns], timings)
+        match = matcher.match
+        before = out[:len(out) - len(match.group(0))]
+        return ExpectResult(matcher.index, match, before,
+                            self._leftovers['err'] + self._leftovers['out'])
+
 
-def bash_command_terminator(outfile, encoding):
+class CommandStream(object):
+    """Iterator over the output of a command sent with
+    LocalConnection.send_stream().
+
+    Gives ('out', line) and ('err', line) tuples, without the newline, in
+    the order they are read. Once finished the return code is available as
+    return_code, and on the connection as usual.
+    """
+
+    def __init__(self, connection, text, timeout=10.0):
+        """
+
+        :param LocalConnection connection: Connection to send the command on.
+        :param str text: Command to run.
+        :param float timeout: Maximum time to wait for each line.
+        """
+        self.connection = connection
+        self.command = text
+        self.timeout = timeout
+        self.return_code = None
+        self._started_at = time.time()
+        self._pending = collections.deque()
+        self._framers = {'out': LineFramer(connection.encoding),
+                         'err': LineFramer(connection.encoding)}
+        self._open = {'out': True, 'err': True}
+        self._poller = connection._poller()
+        connection._leftovers = {'out': '', 'err': ''}
+        buf = io.BytesIO()
+        buf.write((text + '\n').encode(connection.encoding))
+        self._get_output = connection.terminator(
+            buf, connection.encoding, stderr=True)[1]
+        connection.logger.info('In: %s', repr(text))
+        connection.process.stdin.write(buf.getvalue())
+
+    @property
+    def finished(self):
+        return not any(self._open.values())
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._pending:
+            if self.finished:
+                raise StopIteration
+            self._fill()
+        return self._pending.popleft()
+
+    next = __next__
+
+    # Signals close() stops the command with, and how long each gets
+    stop_signals = ((signal.SIGINT, 0.5), (signal.SIGTERM, 0.5),
+                    (signal.SIGKILL, None))
+
+    def close(self):
+        """Stop the command if it's still running, and read and discard the
+        rest of its output, so the connection can be used for the next
+        command.
+
+        The command is sent each of stop_signals in turn (see
+        LocalConnection.interrupt()) until it ends, the last waiting for up
+        to timeout.
+
+        :raises TimeOutError: If it doesn't end.
+        """
+        self._pending.clear()
+        for sig, wait in self.stop_signals:
+            if self.finished:
+                return
+            self.connection.interrupt(sig)
+            deadline = time.time() + (self.timeout if wait is None else wait)
+            while not self.finished and time.time() < deadline:
+                try:
+                    self._fill(deadline - time.time())
+                except TimeOutError:
+                    break
+                self._pending.clear()
+        if not self.finished:
+            self.connection.logger.info('Timed out')
+            raise TimeOutError()
+
+    def _fill(self, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        started_at = time.time()
+        while True:
+            remaining = timeout - (time.time() - started_at)
+            if remaining <= 0:
+                self.connection.logger.info('Timed out')
+                raise TimeOutError()
+            out, err = self.connection._poll_read(self._poller, remaining)
+            if out or err:
+                break
+        for source, data in (('err', err), ('out', out)):
+            if self._open[source]:
+                for line in self._framers[source].feed(data):
+                    self._line(source, line)
+
+    def _line(self, source, line):
+        if not self._open[source]:
+            # Shouldn't happen, nothing else has been sent yet
+            self.connection._leftovers[source] += line
+            return
+        text, rc = self._get_output(line)
+        if source == 'out' and rc is not None:
+            self.return_code = rc
+        elif source != 'err' or text == line:
+            self._pending.append((source, line[:-1]))
+            return
+        # The marker follows on from any output that didn't end in a newline
+        if text.strip('\n'):
+            self._pending.append((source, text.rstrip('\n')))
+        self._open[source] = False
+        if self.finished:
+            self._finish()
+
+    def _finish(self):
+        connection = self.connection
+        connection.last_return_code = self.return_code
+        connection.last_stderr = ''
+        # Output isn't kept, but the command is still part of the record
+        timings = {'total': time.time() - self._started_at}
+        connection.transcript.append(CommandRecord(
+            self.command, '', '', self.return_code, timings, remember=False))
+        connection._timed(self.command, timings)
+
+
+class OutputCollector(object):
+    """Collects output read from a process's stdout and stderr, checking it
+    against a matcher to know when to stop.
+    """
+
+    def __init__(self, done_func, line_func=None, logger=None):
+        """
+
+        :param done_func: Matcher (see pytest_shell.matching), compiled regex,
+            or function called with all output collected so far after each
+            line that returns True when no more is wanted.
+        :param callable line_func: Optional function called with the source
+            ('s' or 'e') and text of each complete line as it's collected.
+        :param logging.Logger logger: Logger for debug output.
+        """
+        self.matcher = as_matcher(done_func)
+        self.matcher.reset()
+        self.line_func = line_func
+        self._framers = {'s': LineFramer(), 'e': LineFramer()}
+        self.logger = logger or logging.getLogger(__name__)
+        self._out = []
+        self._stderr = []
+        self._length = 0
+        self.leftovers = {'out': '', 'err': ''}
+
+    @property
+    def out(self):
+        return ''.join(self._out)
+
+    @property
+    def stderr(self):
+        return ''.join(self._stderr)
+
+    def feed(self, read_out, read_err):
+        """Collect newly read output until the matcher is satisfied, keeping
+        anything after the match in leftovers.
+
+        :param str read_out: Text read from stdout.
+        :param str read_err: Text read from stderr.
+        :return: Whether the matcher was satisfied.
+        :rtype: bool
+        """
+        for source, text in (('e', read_err), ('s', read_out)):
+            if not text:
+                continue
+            end = self.matcher.feed(text)
+            if end is None:
+                self._add(source, text)
+                continue
+            cut = max(end - self._length, 0)
+            self._add(source, text[:cut])
+            rest = text[cut:]
+            self.logger.debug('Matched at %d (%r remaining)', end, rest)
+            if source == 'e':
+                self.leftovers = {'out': read_out, 'err': rest}
+            else:
+                self.leftovers = {'out': rest, 'err': ''}
+            return True
+        return False
+
+    def _add(self, source, text):
+        self._out.append(text)
+        self._length += len(text)
+        if source == 'e':
+            self._stderr.append(text)
+        if self.line_func:
+            for line in self._framers[source].feed(text):
+                self.line_func(source, line)
+
+
+def bash_ready_check(outfile, encoding):
+    """Ready check for LocalConnection that has bash print a marker.
+
+    :param handle outfile: Handle to write the command to.
+    :param str encoding: Encoding to use.
+    :return: Matcher for the marker.
+    """
+    marker = uuid.uuid4().hex
+    # Split like the terminator so an echo of the command doesn't count
+    outfile.write(("printf '%%s-----READY-----\\n' %s\n" % marker).encode(
+        encoding))
+    return SubstringMatcher(marker + '-----READY-----', line=True)
+
+
+def bash_command_terminator(outfile, encoding, stderr=False):
     """Helper function to work out when a command has finished and get the
     return code.
 
@@ -217,13 +788,52 @@ def bash_command_terminator(outfile, encoding):
 
     :param handle outfile: Handle to read and write from/to.
     :param str encoding: Encoding to use.
+    :param bool stderr: Also write a marker to stderr and don't consider the
+        command finished until both have been seen, so everything the command
+        wrote to stderr is known to have been read.
     :return (callable, callable): A function that determines when the running
-        command has finished, and a second
-        to determine the output and return code.
+        command has finished, and a second that takes the output and returns
+        a tuple of the output with the terminator removed and the return code
+        of the command.
     """
-    terminator = uuid.uuid4().hex + '-----' + 'TERMINATOR' + '-----'
-    # Somewhat of a hack to print something out and keep the previous exit code
-    outfile.write(('/bin/bash -c "echo %s && (exit $?)"\n'
-                   % terminator).encode(encoding))
-    return (lambda data: terminator in data, 
-            lambda data: re.sub(r'\s*%s\s*' % terminator, '', data))
+    terminator = uuid.uuid4().hex
+    # Only builtins here so nothing is forked. The status is stashed, printed
+    # after the marker and then restored by returning it from a throwaway
+    # function, leaving $? as the user's command left it. The marker is split
+    # across the printf format and argument so an echo of this line never
+    # looks like the real thing.
+    outfile.write((
+        '__pytest_shell_rc=$?; '
+        'printf \'%%s-----TERMINATOR-----:%%d\\n\' %s "$__pytest_shell_rc"; '
+        '%s'
+        '__pytest_shell_ret() { unset -f __pytest_shell_ret; '
+        'unset __pytest_shell_rc; return "$1"; }; '
+        '__pytest_shell_ret "$__pytest_shell_rc"\n' % (
+            terminator,
+            'printf \'%%s-----TERMINATOR-----\\n\' %s >&2; ' % terminator
+            if stderr else '')
+    ).encode(encoding))
+    marker = terminator + '-----TERMINATOR-----'
+
+    def get_output(data):
+        # Plain string searches, a regex looking for any marker is very slow
+        # on output that looks like hex
+        if stderr:
+            data = data.replace(marker + '\n', '')
+            if data.endswith(marker):
+                data = data[:-len(marker)]
+        start = data.rfind(marker + ':')
+        if start < 0:
+            return data, None
+        match = _RETURN_CODE.match(data, start + len(marker))
+        while start and data[start - 1].isspace():
+            start -= 1
+        return data[:start] + data[match.end():], int(match.group(1))
+
+    # With stderr the marker is seen once on each stream
+    return (SubstringMatcher(marker, count=2 if stderr else 1, line=True),
+            get_output)
+
+
+# Compiled once up front, there are a lot of terminators
+_RETURN_CODE = re.compile(r':(\d+)\s*')
@@ -1,8 +1,12 @@
 import abc
+import base64
 import pipes
+import re
 
 import six
 
+from pytest_shell.connection import TimeOutError
+
 
 class RawCommand(object):
     def __init__(self, cmd):
@@ -79,6 +83,26 @@ class Dialect(object):
     def start_subshell(self):
         pass
 
+    @abc.abstractmethod
+    def state(self):
+        pass
+
+    @abc.abstractmethod
+    def save_state(self):
+        pass
+
+    @abc.abstractmethod
+    def restore_state(self, state, kill_jobs=True, busy_timeout=0.5):
+        pass
+
+    @abc.abstractmethod
+    def checkpoint(self):
+        pass
+
+    @abc.abstractmethod
+    def rollback(self, checkpoint):
+        pass
+
     @abc.abstractmethod
     def exit(self):
         pass
@@ -88,28 +112,84 @@ class BashDialect(Dialect):
 
     @property
     def envvars(self):
-        """
+        """Environment variables of the shell.
+
+        These are cached until another command is sent that might have
+        changed them (see LocalConnection.generation), and a copy is
+        returned each time so changing it has no effect.
 
-        .. fixme:: make this readonly or handle setting it
-        :return:
+        :rtype: dict
         """
-        out = self.connection.send('env', remember=False)
-        vars = {}
-        for line in out.splitlines():
-            name, value = line.split('=', 1)
-            vars[name] = value
-        return vars
+        cached = getattr(self, '_envvars_cache', None)
+        if cached is None or cached[0] != self.connection.generation:
+            envvars = self.parse_envvars(self.connection.send(
+                self.envvars_command(), remember=False, readonly=True))
+            cached = self._envvars_cache = (self.connection.generation,
+                                            envvars)
+        return dict(cached[1])
+
+    def state(self):
+        """Get the environment, working directory, last return code, shell
+        options and function names in one go.
+
+        :rtype: ShellSnapshot
+        """
+        out = self.connection.send(self.state_command(), remember=False,
+                                   readonly=True)
+        snapshot = self.parse_state(out)
+        self._envvars_cache = (self.connection.generation, snapshot.envvars)
+        return snapshot
 
     def __init__(self, connection):
         self.connection = connection
 
     def path_exists(self, path):
-        self.connection.send('stat %s' % path, remember=False)
-        return 'No such file or directory' not in self.connection.last_stderr
+        self.connection.send(self.path_exists_command(path), remember=False,
+                             readonly=True)
+        return self.parse_path_exists(self.connection.last_stderr)
 
     def file_contents(self, path):
         if self.path_exists(path):
-            return self.connection.send('cat %s' % path, remember=False)
+            return self.connection.send(self.file_contents_command(path),
+                                        remember=False, readonly=True)
+
+    def paths_exist(self, paths):
+        """Check whether each of several paths exists, in one command.
+
+        Paths are taken literally, without globbing or ~ expansion.
+
+        :param list[str] paths: Paths to check.
+        :rtype: list[bool]
+        """
+        out = self.connection.send(self.paths_exist_command(paths),
+                                   remember=False, readonly=True)
+        return self.parse_paths_exist(out)
+
+    def stat_many(self, paths):
+        """Get the type, size, mode and modification time of several paths
+        in one command, see paths_exist().
+
+        :param list[str] paths: Paths to look at.
+        :rtype: list[PathInfo]
+        """
+        out = self.connection.send(self.stat_many_command(paths),
+                                   remember=False, readonly=True)
+        return self.parse_stat_many(paths, out)
+
+    def file_contents_many(self, paths, binary=False):
+        """Get the contents of several files in one command, see
+        paths_exist().
+
+        :param list[str] paths: Files to read.
+        :param bool binary: Give bytes rather than decoding the contents.
+        :return: The contents of each file, or None if it isn't a readable
+            file.
+        :rtype: list[str]
+        """
+        out = self.connection.send(self.file_contents_many_command(paths),
+                                   remember=False, readonly=True)
+        return self.parse_file_contents_many(
+            out, None if binary else self.connection.encoding)
 
     def run_script_inline(self, lines):
         # TODO: join with newlines prior to sending?
@@ -119,23 +199,171 @@ class BashDialect(Dialect):
         return '\n'.join(out)
 
     def run_script(self, path, args=None):
-        cmd = ' '.join(pipes.quote(str(s)) for s in [path] + (args or []))
-        return self.connection.send(cmd)
+        return self.connection.send(self.run_script_command(path, args))
 
     def set_env(self, name, value):
-        self.connection.send('export %s=%s' % (name, pipes.quote(value)),
+        self.connection.send(self.set_env_command(name, value),
                              remember=False)
 
     def source(self, fname):
-        self.connection.send('source %s' % fname, remember=False)
+        self.connection.send(self.source_command(fname), remember=False)
 
     def cd(self, path):
-        self.connection.send('cd %s' % pipes.quote(path))
+        self.connection.send(self.cd_command(path))
+
+    def bootstrap(self, pwd=None, envvars=None, sources=None):
+        """Change directory, set environment variables and source files,
+        in that order, in a single round-trip.
+
+        :param str pwd: Directory to change to.
+        :param dict envvars: Environment variables to export.
+        :param list sources: Files to source.
+        :return: Each command that failed, with its return code and output
+            (stdout and stderr together).
+        :rtype: list[(str, int, str)]
+        """
+        commands = self.bootstrap_commands(pwd, envvars, sources)
+        if not commands:
+            return []
+        out = self.connection.send(self.bootstrap_command(commands),
+                                   remember=False)
+        return self.parse_bootstrap(commands, out)
 
     def return_code(self):
+        # The bash terminator reports the status along with the output, only
+        # ask the shell if the connection couldn't tell us.
+        if self.connection.last_return_code is not None:
+            return self.connection.last_return_code
         rc = int(self.connection.send('echo $?', remember=False))
         return rc
 
+    def save_state(self):
+        """Capture the state of the shell so it can be put back later with
+        restore_state().
+
+        This covers variables, the working directory, umask, shell options,
+        functions, aliases and traps (see checkpoint()), and takes a single
+        round-trip.
+
+        :return: An opaque object to pass to restore_state().
+        """
+        out = self.connection.send(
+            'printf "%%s\\0" "$BASHPID"; %s' % self.checkpoint_command(),
+            remember=False, readonly=True)
+        pid, out = out.split('\0', 1)
+        return ShellState(pid, self.parse_checkpoint(out))
+
+    def restore_state(self, state, kill_jobs=True, busy_timeout=0.5):
+        """Put the shell back to how it was when save_state() was called.
+
+        Only builtins are used, and only what changed is put back, so this
+        is one round-trip to see what changed and one to undo it.
+
+        :param state: The result of save_state().
+        :param bool kill_jobs: Kill any background jobs started since.
+        :param float busy_timeout: How long to wait for the shell to answer
+            before giving up on it, e.g. if it's still running a command.
+        :return: False if this isn't the shell the state came from (e.g. a
+            subshell has been left running) or it's busy, otherwise True.
+        :rtype: bool
+        """
+        try:
+            out = self.connection.send(
+                'printf "%%s\\0" "$BASHPID"; jobs -p; printf "\\0"; %s'
+                % self.checkpoint_command(), remember=False, readonly=True,
+                timeout=busy_timeout, soft_timeout=False)
+        except TimeOutError:
+            return False
+        # Anything a command left unread comes first
+        pid, jobs, out = out.split('\0', 2)
+        if pid.splitlines()[-1:] != [state.pid]:
+            return False
+        jobs = ' '.join(jobs.split())
+        kill = []
+        if kill_jobs and jobs:
+            kill.append('{ builtin kill -9 %s; builtin wait %s; } '
+                        '2>/dev/null' % (jobs, jobs))
+        script = self._rollback_script(state.checkpoint,
+                                       self.parse_checkpoint(out), kill)
+        if script:
+            self.connection.send(script, remember=False)
+        if hasattr(self, '_shared'):
+            self._shared['checkpoint'] = (self.connection.generation,
+                                          state.checkpoint)
+        return True
+
+    def checkpoint(self):
+        """Capture the state of the shell cheaply, so changes made in a
+        nested session can be undone with rollback().
+
+        This covers variables, the working directory, umask, shell options,
+        functions, aliases and traps like save_state(), but only uses
+        builtins (so nothing is forked) and rollback() only puts back what
+        changed.
+
+        :rtype: ShellCheckpoint
+        """
+        # Kept until the shell might have changed, so nesting in a loop
+        # doesn't ask again each time it's back where it started
+        shared = getattr(self, '_shared', {})
+        cached = shared.get('checkpoint')
+        if cached is None or cached[0] != self.connection.generation:
+            cached = shared['checkpoint'] = (
+                self.connection.generation,
+                self.parse_checkpoint(self.connection.send(
+                    self.checkpoint_command(), remember=False,
+                    readonly=True)))
+        return cached[1]
+
+    def rollback(self, checkpoint):
+        """Undo any changes made since checkpoint() was called.
+
+        :param ShellCheckpoint checkpoint: The result of checkpoint().
+        """
+        script = self._rollback_script(checkpoint, self.checkpoint())
+        if script:
+            self.connection.send(script, remember=False)
+        if hasattr(self, '_shared'):
+            self._shared['checkpoint'] = (self.connection.generation,
+                                          checkpoint)
+
+    def _rollback_script(self, checkpoint, current, first=()):
+        """rollback_script(), with errexit off while it runs so a failure
+        putting things back doesn't end the shell, and back on at the end if
+        checkpoint had it.
+
+        :param list first: Commands to run before it, also with errexit off.
+        :rtype: str
+        """
+        before = 'errexit' in checkpoint.setopts
+        now = 'errexit' in current.setopts
+        if before or now:
+            # Copies without it, as checkpoints can be cached
+            checkpoint, current = [
+                ShellCheckpoint(*[getattr(c, name)
+                                  for name in ShellCheckpoint.__slots__])
+                for c in (checkpoint, current)]
+            checkpoint.setopts = checkpoint.setopts - set(['errexit'])
+            current.setopts = current.setopts - set(['errexit'])
+        script = [line for line in list(first) + [
+            self.rollback_script(checkpoint, current)] if line]
+        if script:
+            if now:
+                script.insert(0, 'set +e')
+            if before:
+                script.append('set -e')
+        elif before != now:
+            script.append('set -e' if before else 'set +e')
+        return '\n'.join(script)
+
+    _dynamic_variables = [
+        'BASH_ARGC', 'BASH_ARGV', 'BASH_COMMAND', 'BASH_LINENO',
+        'BASH_REMATCH', 'BASH_SOURCE', 'BASH_SUBSHELL', 'BASHOPTS', 'BASHPID',
+        'EPOCHREALTIME', 'EPOCHSECONDS', 'FUNCNAME', 'GROUPS', 'HISTCMD',
+        'LINENO',
+        'PIPESTATUS', 'RANDOM', 'SECONDS', 'SHELLOPTS', 'SRANDOM', '_',
+    ]
+
     def start_subshell(self):
         self.connection.send(BashDialect.run_command(), remember=False)
         self.connection.drain()
@@ -146,3 +374,356 @@ class BashDialect(Dialect):
     @classmethod
     def run_command(cls):
         return '/bin/bash'
+
+    # The commands behind the helpers above and the parsing of their output,
+    # so they can be shared by sessions that send commands differently (e.g.
+    # pytest_shell.aio).
+
+    @classmethod
+    def envvars_command(cls):
+        # NUL separated so values can have newlines in them
+        return 'env -0'
+
+    @classmethod
+    def parse_envvars(cls, out):
+        vars = {}
+        for item in out.split('\0'):
+            if item:
+                name, value = item.split('=', 1)
+                vars[name] = value
+        return vars
+
+    @classmethod
+    def checkpoint_command(cls):
+        # Builtins only, and as little output as possible (e.g. options from
+        # $BASHOPTS and $SHELLOPTS rather than shopt -p and set +o), as
+        # this is sent twice for every nested session
+        return (
+            "{ printf 'builtin cd -- %q\\0%s\\0%s\\0' \"$PWD\" "
+            "\"$BASHOPTS\" \"$SHELLOPTS\"; umask -p; printf '\\0'; "
+            "trap -p; printf '\\0'; alias -p; printf '\\0'; declare -F; "
+            "printf '\\0'; declare -f; printf '\\0'; declare -p; "
+            "} 2>/dev/null")
+
+    # Not put back by rollback(): ones bash manages itself, and ones that
+    # follow other things rollback() does
+    _checkpoint_skipped = frozenset([
+        'BASH_ALIASES', 'BASH_CMDS', 'DIRSTACK', 'OLDPWD', 'PWD',
+    ] + _dynamic_variables)
+
+    _declaration = re.compile(r'^declare -(\S+) ([A-Za-z_][A-Za-z0-9_]*)',
+                              re.M)
+
+    @classmethod
+    def parse_checkpoint(cls, out):
+        fields = out.split('\0')
+        (cd, shopts, setopts, umask, traps, aliases, function_names,
+         functions) = fields[:8]
+        declarations = '\0'.join(fields[8:])
+        variables = {}
+        matches = list(cls._declaration.finditer(declarations))
+        # Bash quotes newlines in values ($'...') so each is one line, but
+        # older versions don't
+        for match, end in zip(matches, [m.start() for m in matches[1:]] +
+                              [len(declarations)]):
+            name = match.group(2)
+            # Our own (e.g. those of a zygote's child) are left alone too
+            if 'r' not in match.group(1) and \
+                    name not in cls._checkpoint_skipped and \
+                    not name.startswith('__pytest_shell_'):
+                variables[name] = declarations[match.start():end].rstrip('\n')
+        return ShellCheckpoint(cd, umask.strip(),
+                               set(shopts.split(':')) - {''},
+                               set(setopts.split(':')) - {''}, traps, aliases,
+                               function_names.split()[2::3], functions,
+                               variables)
+
+    @classmethod
+    def rollback_script(cls, checkpoint, current):
+        """Commands to get from one checkpoint back to an earlier one, or an
+        empty string if there's nothing to do.
+
+        :param ShellCheckpoint checkpoint: The earlier checkpoint.
+        :param ShellCheckpoint current: Where the shell is now.
+        :rtype: str
+        """
+        before, after = checkpoint.variables, current.variables
+        script = []
+        added = sorted(set(after) - set(before))
+        if added:
+            script.append('builtin unset -v %s' % ' '.join(added))
+        for name in sorted(before):
+            if after.get(name) != before[name]:
+                # Unset first, or attributes (e.g. export) given since stay
+                script.append('builtin unset -v %s' % name)
+                script.append(before[name])
+        if current.functions != checkpoint.functions:
+            if current.function_names:
+                script.append('builtin unset -f %s'
+                              % ' '.join(current.function_names))
+            script.append(checkpoint.functions)
+        if current.aliases != checkpoint.aliases:
+            script.append('unalias -a')
+            script.append(checkpoint.aliases)
+        if current.traps != checkpoint.traps:
+            script.append('trap - EXIT ERR DEBUG RETURN %s'
+                          % ' '.join(str(i) for i in range(1, 65)))
+            script.append(checkpoint.traps)
+        # Only the options that changed, as setting some has side effects
+        # (e.g. the compat ones set BASH_COMPAT)
+        for command, before, after in [
+                ('shopt -%s %s', checkpoint.shopts, current.shopts),
+                ('set %so %s', checkpoint.setopts, current.setopts)]:
+            on = 's' if command.startswith('shopt') else '-'
+            off = 'u' if command.startswith('shopt') else '+'
+            for name in sorted(before - after):
+                script.append(command % (on, name))
+            for name in sorted(after - before):
+                script.append(command % (off, name))
+        for field in ('umask', 'cd'):
+            if getattr(current, field) != getattr(checkpoint, field):
+                script.append(getattr(checkpoint, field))
+        script = [line.rstrip('\n') for line in script if line.strip()]
+        if not script:
+            return ''
+        return '{\n%s\n} 2>/dev/null' % '\n'.join(script)
+
+    @classmethod
+    def state_command(cls):
+        # $? has to come first, before anything else changes it, and is put
+        # back at the end. The environment is ended by an empty item, which
+        # env never prints.
+        return ("__pytest_shell_st=$?; "
+                "printf '%s\\0' \"$__pytest_shell_st\" \"$PWD\"; env -0; "
+                "printf '\\0'; set +o; printf '\\0'; compgen -A function; "
+                "__pytest_shell_ret() { unset -f __pytest_shell_ret; "
+                "unset __pytest_shell_st; return \"$1\"; }; "
+                "__pytest_shell_ret \"$__pytest_shell_st\"")
+
+    @classmethod
+    def parse_state(cls, out):
+        rc, cwd, rest = out.split('\0', 2)
+        env, rest = rest.split('\0\0', 1)
+        options, functions = rest.split('\0', 1)
+        return ShellSnapshot(
+            envvars=cls.parse_envvars(env),
+            cwd=cwd,
+            return_code=int(rc),
+            options=dict((line.split()[2], line.split()[1] == '-o')
+                         for line in options.splitlines() if line),
+            functions=functions.split())
+
+    @classmethod
+    def path_exists_command(cls, path):
+        return 'stat %s' % path
+
+    @classmethod
+    def parse_path_exists(cls, stderr):
+        return 'No such file or directory' not in stderr
+
+    @classmethod
+    def file_contents_command(cls, path):
+        return 'cat %s' % path
+
+    # Only builtins for the checks, and a single stat for all existing paths
+
+    @classmethod
+    def paths_exist_command(cls, paths):
+        return ('for __pytest_shell_p in %s; do '
+                '[[ -e $__pytest_shell_p || -L $__pytest_shell_p ]] '
+                '&& printf 1 || printf 0; done; unset __pytest_shell_p' %
+                ' '.join(pipes.quote(p) for p in paths))
+
+    @classmethod
+    def parse_paths_exist(cls, out):
+        return [c == '1' for c in out.strip()]
+
+    @classmethod
+    def stat_many_command(cls, paths):
+        return (
+            '__pytest_shell_e=(); for __pytest_shell_p in %s; do '
+            'if [[ -e $__pytest_shell_p || -L $__pytest_shell_p ]]; then '
+            'printf 1; __pytest_shell_e+=("$__pytest_shell_p"); '
+            'else printf 0; fi; done; printf "\\0"; '
+            '(( ${#__pytest_shell_e[@]} )) && '
+            'stat --printf "%%F\\0%%s\\0%%a\\0%%Y\\0" -- '
+            '"${__pytest_shell_e[@]}"; '
+            'unset __pytest_shell_e __pytest_shell_p' %
+            ' '.join(pipes.quote(p) for p in paths))
+
+    @classmethod
+    def parse_stat_many(cls, paths, out):
+        exists, rest = out.split('\0', 1)
+        fields = rest.split('\0')
+        result = []
+        for path, exist in zip(paths, exists):
+            if exist != '1':
+                result.append(PathInfo(path, False))
+                continue
+            type_, size, mode, mtime = fields[:4]
+            del fields[:4]
+            result.append(PathInfo(path, True, cls._file_types.get(
+                type_, type_), int(size), int(mode, 8), int(mtime)))
+        return result
+
+    _file_types = {
+        'regular file': 'file',
+        'regular empty file': 'file',
+        'directory': 'directory',
+        'symbolic link': 'symlink',
+    }
+
+    @classmethod
+    def file_contents_many_command(cls, paths):
+        return ('for __pytest_shell_p in %s; do '
+                'if [[ -f $__pytest_shell_p && -r $__pytest_shell_p ]]; then '
+                'printf 1; base64 -w0 -- "$__pytest_shell_p"; '
+                'else printf 0; fi; echo; done; unset __pytest_shell_p' %
+                ' '.join(pipes.quote(p) for p in paths))
+
+    @classmethod
+    def parse_file_contents_many(cls, out, encoding=None):
+        result = []
+        for line in out.splitlines():
+            if not line.startswith('1'):
+                result.append(None)
+                continue
+            data = base64.b64decode(line[1:])
+            result.append(data.decode(encoding) if encoding else data)
+        return result
+
+    @classmethod
+    def run_script_command(cls, path, args=None):
+        return ' '.join(pipes.quote(str(s)) for s in [path] + (args or []))
+
+    @classmethod
+    def set_env_command(cls, name, value):
+        return 'export %s=%s' % (name, pipes.quote(value))
+
+    @classmethod
+    def source_command(cls, fname):
+        return 'source %s' % fname
+
+    @classmethod
+    def cd_command(cls, path):
+        return 'cd %s' % pipes.quote(path)
+
+    @classmethod
+    def bootstrap_commands(cls, pwd=None, envvars=None, sources=None):
+        commands = [cls.cd_command(pwd)] if pwd else []
+        commands.extend(cls.set_env_command(name, value)
+                        for name, value in (envvars or {}).items())
+        commands.extend(cls.source_command(fname) for fname in sources or [])
+        return commands
+
+    @classmethod
+    def bootstrap_command(cls, commands):
+        # Each command's output then its return code, NUL terminated. The
+        # newline before } is in case a command ends with a comment.
+        return '\n'.join('{ %s\n} 2>&1; printf \'\\0%%s\\0\' "$?"' % command
+                         for command in commands)
+
+    @classmethod
+    def parse_bootstrap(cls, commands, out):
+        fields = out.split('\0')
+        return [(command, int(rc), output) for command, output, rc
+                in zip(commands, fields[0::2], fields[1::2]) if rc != '0']
+
+
+class PathInfo(object):
+    """Information about a path from BashDialect.stat_many()."""
+
+    __slots__ = ('path', 'exists', 'type', 'size', 'mode', 'mtime')
+
+    def __init__(self, path, exists, type=None, size=None, mode=None,
+                 mtime=None):
+        """
+
+        :param str path: The path.
+        :param bool exists: Whether it exists, if not the rest are None.
+        :param str type: 'file', 'directory', 'symlink', or as given by
+            stat(1) for anything else.
+        :param int size: Size in bytes.
+        :param int mode: Permission bits, e.g. 0o644.
+        :param int mtime: Modification time, in seconds since the epoch.
+        """
+        self.path = path
+        self.exists = exists
+        self.type = type
+        self.size = size
+        self.mode = mode
+        self.mtime = mtime
+
+    def __repr__(self):
+        return 'PathInfo(%r, exists=%r, type=%r)' % (self.path, self.exists,
+                                                     self.type)
+
+
+class ShellSnapshot(object):
+    """Shell state read by BashDialect.state()."""
+
+    __slots__ = ('envvars', 'cwd', 'return_code', 'options', 'functions')
+
+    def __init__(self, envvars, cwd, return_code, options, functions):
+        """
+
+        :param dict envvars: Environment variables.
+        :param str cwd: Working directory.
+        :param int return_code: Return code of the last command.
+        :param dict options: Whether each ``set -o`` option is on.
+        :param list[str] functions: Names of defined functions.
+        """
+        self.envvars = envvars
+        self.cwd = cwd
+        self.return_code = return_code
+        self.options = options
+        self.functions = functions
+
+
+class ShellCheckpoint(object):
+    """Shell state captured by BashDialect.checkpoint(). The strings are
+    what the shell prints for each, which can be run to put it back.
+    """
+
+    __slots__ = ('cd', 'umask', 'shopts', 'setopts', 'traps', 'aliases',
+                 'function_names', 'functions', 'variables')
+
+    def __init__(self, cd, umask, shopts, setopts, traps, aliases,
+                 function_names, functions, variables):
+        """
+
+        :param str cd: Command to change to the working directory.
+        :param str umask: ``umask -p``.
+        :param set shopts: Names of ``shopt`` options that are on.
+        :param set setopts: Names of ``set -o`` options that are on.
+        :param str traps: ``trap -p``.
+        :param str aliases: ``alias -p``.
+        :param list[str] function_names: Names of defined functions.
+        :param str functions: ``declare -f``.
+        :param dict variables: ``declare -p`` of each variable (apart from
+            readonly ones), by name.
+        """
+        self.cd = cd
+        self.umask = umask
+        self.shopts = shopts
+        self.setopts = setopts
+        self.traps = traps
+        self.aliases = aliases
+        self.function_names = function_names
+        self.functions = functions
+        self.variables = variables
+
+
+class ShellState(object):
+    """Shell state captured by BashDialect.save_state()."""
+
+    __slots__ = ('pid', 'checkpoint')
+
+    def __init__(self, pid, checkpoint):
+        """
+
+        :param str pid: Process ID of the shell the state was taken from.
+        :param ShellCheckpoint checkpoint: The state itself.
+        """
+        self.pid = pid
+        self.checkpoint = checkpoint
@@ -0,0 +1,69 @@
+import heapq
+import itertools
+import threading
+
+
+class CommandDurations(object):
+    """Keeps the slowest commands run during a test session, for
+    --shell-durations.
+    """
+
+    def __init__(self, count):
+        """
+
+        :param int count: Number of commands to keep.
+        """
+        self.count = count
+        self.nodeid = None
+        self._slowest = []
+        self._counter = itertools.count()
+        # Shells can be started on another thread, see ShellPool.warm()
+        self._lock = threading.Lock()
+
+    def __call__(self, command, timings):
+        """Record a command run by the current test, see
+        LocalConnection.timings_sink.
+        """
+        self._add(self.nodeid, command, timings)
+
+    def merge(self, slowest):
+        """Add commands recorded elsewhere, e.g. by an xdist worker.
+
+        :param list slowest: Result of slowest() from another instance.
+        """
+        for nodeid, command, timings in slowest:
+            self._add(nodeid, command, timings)
+
+    def _add(self, nodeid, command, timings):
+        # The counter breaks ties so dicts are never compared
+        with self._lock:
+            entry = (timings.get('total', 0.0), next(self._counter),
+                     nodeid, command, timings)
+            if len(self._slowest) < self.count:
+                heapq.heappush(self._slowest, entry)
+            elif entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        """
+        :return: Test node ID, command and timings of the slowest commands,
+            slowest first.
+        :rtype: list[(str, str, dict)]
+        """
+        with self._lock:
+            entries = sorted(self._slowest, reverse=True)
+        return [(nodeid, command, timings)
+                for _, _, nodeid, command, timings in entries]
+
+    def lines(self):
+        """Lines for the terminal summary."""
+        for nodeid, command, timings in self.slowest():
+            yield '%.2fs %s: %s' % (timings.get('total', 0.0),
+                                    nodeid or '(no test)', command)
+            yield ('    write %.3fs, first byte %.3fs, terminator %.3fs, '
+                   'drain %.3fs, %d bytes' % (
+                       timings.get('write', 0.0),
+                       timings.get('first_byte', 0.0),
+                       timings.get('terminator', 0.0),
+                       timings.get('drain', 0.0),
+                       timings.get('bytes', 0)))
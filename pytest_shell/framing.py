@@ -0,0 +1,53 @@
+import codecs
+
+
+class LineFramer(object):
+    """Turns chunks of bytes read from a stream into lines of text.
+
+    Decoding is incremental, so characters split across chunks are fine, and
+    anything after the last newline is held back until the rest of the line
+    arrives (or flush() is called).
+    """
+
+    def __init__(self, encoding=None, errors='strict'):
+        """
+
+        :param str encoding: Encoding of the stream. If None, the stream has
+            already been decoded and is fed as text.
+        :param str errors: How to handle decoding errors, as for
+            bytes.decode().
+        """
+        self._decoder = (codecs.getincrementaldecoder(encoding)(errors)
+                         if encoding else None)
+        self._partial = ''
+
+    @property
+    def partial(self):
+        """Text of the line currently being built up."""
+        return self._partial
+
+    def feed(self, data):
+        """Add some bytes from the stream.
+
+        :param bytes data: Data read from the stream (or text, see
+            __init__()).
+        :return: Lines completed by this data, including their newlines.
+        :rtype: list[str]
+        """
+        if self._decoder is not None:
+            data = self._decoder.decode(data)
+        lines = (self._partial + data).split('\n')
+        self._partial = lines.pop()
+        return [line + '\n' for line in lines]
+
+    def flush(self):
+        """Give up waiting for the rest of the current line.
+
+        :return: The partial line, which may be empty.
+        :rtype: str
+        """
+        text = self._partial
+        if self._decoder is not None:
+            text += self._decoder.decode(b'', True)
+        self._partial = ''
+        return text
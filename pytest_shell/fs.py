@@ -1,41 +1,411 @@
+import collections
+import errno
+import fcntl
+import hashlib
+import json
 import os
 import shutil
+import stat
+import tempfile
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
 
-def create_files(structure, root='/'):
+#: Below this many files they're written on the calling thread, as starting
+#: threads costs more than it saves.
+PARALLEL_THRESHOLD = 64
+
+# From linux/fs.h, clones a file's extents on filesystems that support it
+# (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+
+def create_files(structure, root='/', copy_method='copy', workers=None):
+    """Create a structure of files and directories.
+
+    Anything that already exists is left alone, except that alterations
+    (nodes with just a mode) are always applied.
+
+    :param structure: List (or dict) of nodes, see Node.from_dict().
+    :param str root: Directory to create the structure in.
+    :param str copy_method: How to create files with copyfrom: 'copy',
+        'hardlink' or 'reflink' (copy-on-write clone). Either of the last two
+        falls back to a copy where it isn't possible, and files with a mode
+        are always copied so the source isn't changed.
+    :param int workers: Maximum number of threads to write files with.
+    """
+    if copy_method not in ('copy', 'hardlink', 'reflink'):
+        raise ValueError('Unknown copy method %r' % copy_method)
     if isinstance(structure, dict):
         structure = [{k: v} for k, v in structure.items()]
     root = str(root)
-    structure = [Node.from_dict(i) for i in structure]
-    # Sort the structure so that dirs are created first, files second, and
-    # alters (e.g. chmods) last, and within that smaller paths are created
-    # first. This is mainly to handle sensibly altering files after they've
-    # been created.
-    structure = sorted(structure, key=lambda el: (el.type, len(el.path)))
-    for node in structure:
+    nodes = [Node.from_dict(i) for i in structure]
+    dirs = {}
+    files = []
+    alters = []
+    for node in nodes:
         path = os.path.join(root, node.path)
-        if not os.path.exists(path):
-            if node.type == Node.DIR:
-                os.makedirs(path)
-                if node.mode:
-                    os.chmod(path, node.mode)
-            elif node.type == Node.ALTER:
-                if node.mode:
-                    os.chmod(path, node.mode)
-            else:
-                dir_ = os.path.dirname(path)
-                if not os.path.exists(dir_):
-                    os.makedirs(dir_)
-                if node.copyfrom:
-                    shutil.copy(node.copyfrom, path)
-                elif node.content:
-                    with open(path, 'wb') as f_out:
-                        # TODO: anything better than hard-coding this?
-                        f_out.write(node.content.encode('utf8'))
-                else:
-                    raise Exception('No creation instructions for %s' % path)
-                if node.mode:
-                    os.chmod(path, node.mode)
+        if node.type == Node.DIR:
+            dirs[path] = node.mode
+        elif node.type == Node.FILE:
+            files.append((path, node))
+        else:
+            alters.append((path, node))
+    # Plan every directory needed, so each is created once, parents first
+    for path, _ in files:
+        dir_ = os.path.dirname(path)
+        while dir_ not in dirs and dir_ != root and len(dir_) > 1:
+            dirs[dir_] = None
+            dir_ = os.path.dirname(dir_)
+    for path in sorted(dirs, key=len):
+        _mkdir(path, dirs[path])
+    _each(lambda f: _create_file(f[0], f[1], copy_method), files, workers)
+    _alter(alters, copy_method == 'hardlink')
+
+
+def _alter(alters, linked):
+    """Apply alterations, as (path, node) pairs.
+
+    :param bool linked: Files might be hardlinks, so are copied before their
+        mode is changed, leaving whatever they're linked to alone.
+    """
+    for path, node in alters:
+        if node.mode:
+            if linked:
+                _unshare(path)
+            os.chmod(path, node.mode)
+
+
+def _unshare(path):
+    """Replace a file with several links by a copy of its own."""
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2:
+        return
+    tmp = path + '.pytest_shell_unshare'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    _copy_file(path, tmp, None, True)
+    os.rename(tmp, path)
+
+
+def _each(func, items, workers=None):
+    """Call func with each item, on a thread pool if there are enough.
+
+    :return: The results, in the same order as items.
+    :rtype: list
+    """
+    if (ThreadPoolExecutor is not None and workers != 1 and
+            len(items) >= PARALLEL_THRESHOLD):
+        with ThreadPoolExecutor(max_workers=workers or 8) as pool:
+            # list() so any error is raised here
+            return list(pool.map(func, items))
+    return [func(item) for item in items]
+
+
+def _mkdir(path, mode):
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return
+        if e.errno != errno.ENOENT:
+            raise
+        # Somewhere above the structure (e.g. root) doesn't exist yet
+        os.makedirs(path)
+    if mode:
+        os.chmod(path, mode)
+
+
+def _create_file(path, node, copy_method):
+    if node.copyfrom:
+        if copy_method == 'hardlink' and not node.mode:
+            try:
+                os.link(node.copyfrom, path)
+                return
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    return
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        _copy_file(node.copyfrom, path, node.mode, copy_method == 'reflink')
+    elif node.content is not None:
+        fd = _create(path)
+        if fd is None:
+            return
+        content = node.content
+        if not isinstance(content, bytes):
+            # TODO: anything better than hard-coding this?
+            content = content.encode('utf8')
+        with os.fdopen(fd, 'wb') as f_out:
+            f_out.write(content)
+            if node.mode:
+                os.fchmod(f_out.fileno(), node.mode)
+    else:
+        raise Exception('No creation instructions for %s' % path)
+
+
+def _create(path):
+    """Create a new file, returning its descriptor or None if it exists."""
+    try:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return None
+        raise
+
+
+def _copy_file(source, path, mode, reflink):
+    """Copy a file, as a copy-on-write clone if reflink is set and the
+    filesystem supports it.
+
+    :return: 'reflink' or 'copy', whichever was done, or None if path
+        already existed.
+    """
+    fd = _create(path)
+    if fd is None:
+        return None
+    with open(source, 'rb') as f_in, os.fdopen(fd, 'wb') as f_out:
+        cloned = False
+        if reflink:
+            try:
+                fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+                cloned = True
+            except (IOError, OSError):
+                pass
+        if not cloned:
+            shutil.copyfileobj(f_in, f_out, 1 << 20)
+        os.fchmod(f_out.fileno(), mode or stat.S_IMODE(
+            os.fstat(f_in.fileno()).st_mode))
+    return 'reflink' if cloned else 'copy'
+
+
+class TemplateCache(object):
+    """Builds each distinct structure for create_files() once, and copies it
+    into place after that.
+
+    Templates are keyed by a hash of the structure and the modification
+    times of any copyfrom sources, and kept in a directory that can be reused
+    between sessions (see the fs_templates fixture).
+
+    Node paths are always relative to the root given to create_files(), even
+    if they start with /. Alterations (nodes with just a mode) aren't part of
+    the template and are applied after copying.
+
+    Each template is a directory named after its key and a generation, with
+    the files in tree/ and their manifest (see _manifest()) next to it. It's
+    built to one side and renamed into place, so other processes (e.g. xdist
+    workers) never see half a template, and one that's found to have changed
+    is replaced by building the next generation rather than deleting it
+    while others might be copying it. Old generations are left for the
+    directory's owner to clear (e.g. pytest --cache-clear).
+    """
+
+    def __init__(self, directory=None):
+        """
+
+        :param str directory: Where to keep templates. A temporary directory
+            is used (and removed by close()) if not given.
+        """
+        self._temporary = directory is None
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='pytest_shell_templates')
+        elif not os.path.isdir(str(directory)):
+            os.makedirs(str(directory))
+        self.directory = str(directory)
+        self._manifests = {}
+        self.hits = 0
+        self.misses = 0
+        #: How many times create_files() used each method, see its return
+        #: value.
+        self.methods = collections.Counter()
+
+    def close(self):
+        if self._temporary:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def _nodes(structure):
+        if isinstance(structure, dict):
+            structure = [{k: v} for k, v in structure.items()]
+        nodes = [Node.from_dict(i) for i in structure]
+        return [Node(n.path.lstrip('/'), n.type, n.content, n.mode, n.copyfrom)
+                for n in nodes]
+
+    @staticmethod
+    def key(nodes):
+        """Hash of a list of nodes, see __init__().
+
+        :rtype: str
+        """
+        digest = hashlib.sha256()
+        for node in sorted(nodes, key=lambda n: (n.path, n.type)):
+            if node.type == Node.ALTER:
+                continue
+            content = node.content
+            if content is not None and not isinstance(content, bytes):
+                content = content.encode('utf8')
+            source = None
+            if node.copyfrom:
+                st = os.stat(node.copyfrom)
+                source = (node.copyfrom, st.st_mtime, st.st_size)
+            digest.update(repr((node.path, node.type, node.mode, source))
+                          .encode('utf8'))
+            digest.update(b'\0' if content is None else
+                          ('%d:' % len(content)).encode('ascii') + content)
+        return digest.hexdigest()
+
+    def create_files(self, structure, root, method='auto', workers=None):
+        """Create a structure of files as create_files() would, from a
+        template.
+
+        :param structure: List (or dict) of nodes, see Node.from_dict().
+        :param str root: Directory to create the structure in.
+        :param str method: How to copy files from the template. 'reflink'
+            gives each test its own copy-on-write clone (falling back to a
+            copy) and 'copy' always copies. 'hardlink' is fastest, but the
+            files are shared with the template (and other tests), so they
+            mustn't be changed in place; if they are, the template is rebuilt
+            next time. 'auto' is 'reflink'.
+        :param int workers: Maximum number of threads to copy files with.
+        :return: The method actually used: 'copy' if any file had to be
+            copied, e.g. reflink on a filesystem without copy-on-write
+            (like ext4), where this is no quicker than create_files().
+        :rtype: str
+        """
+        if method not in ('auto', 'reflink', 'copy', 'hardlink'):
+            raise ValueError('Unknown method %r' % method)
+        nodes = self._nodes(structure)
+        template = self.template(nodes, check=method == 'hardlink')
+        used = _clone_tree(template, str(root), method, workers)
+        _alter([(os.path.join(str(root), node.path), node) for node in nodes
+                if node.type == Node.ALTER], method == 'hardlink')
+        self.methods[used] += 1
+        return used
+
+    def template(self, nodes, check=False):
+        """Get the directory with the template for some nodes, building it
+        if needed.
+
+        :param list[Node] nodes: The structure.
+        :param bool check: Make sure the files are as they were built.
+        :rtype: str
+        """
+        key = self.key(nodes)
+        found = self._manifests.get(key) or self._published(key)
+        generation = 0
+        if found is not None:
+            generation, tree, manifest = found
+            if manifest is not None and (
+                    not check or _manifest(tree) == manifest):
+                self._manifests[key] = found
+                self.hits += 1
+                return tree
+            generation += 1
+        self.misses += 1
+        building = tempfile.mkdtemp(prefix=key + '.', dir=self.directory)
+        tree = os.path.join(building, 'tree')
+        os.mkdir(tree)
+        create_files([n for n in nodes if n.type != Node.ALTER], tree,
+                     copy_method='reflink')
+        with open(os.path.join(building, 'manifest.json'), 'w') as f:
+            json.dump(_manifest(tree), f)
+        path = os.path.join(self.directory, '%s-%d' % (key, generation))
+        try:
+            os.rename(building, path)
+        except OSError as e:
+            # Someone else got there first
+            shutil.rmtree(building, ignore_errors=True)
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        found = self._read(path, generation)
+        if found[2] is None:
+            raise IOError(errno.ENOENT, 'template has no manifest', path)
+        self._manifests[key] = found
+        return found[1]
+
+    def _published(self, key):
+        """The latest generation of a template in the directory, as
+        (generation, tree, manifest), or None if there isn't one. manifest
+        is None if it can't be read.
+        """
+        generations = []
+        for name in os.listdir(self.directory):
+            prefix, _, generation = name.rpartition('-')
+            if prefix == key and generation.isdigit():
+                generations.append(int(generation))
+        if not generations:
+            return None
+        generation = max(generations)
+        return self._read(os.path.join(self.directory, '%s-%d' % (
+            key, generation)), generation)
+
+    @staticmethod
+    def _read(path, generation):
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            manifest = None
+        return generation, os.path.join(path, 'tree'), manifest
+
+
+def _manifest(root):
+    """Size, modification time and mode of each file under root."""
+    manifest = {}
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            st = os.lstat(path)
+            manifest[os.path.relpath(path, root)] = [
+                st.st_size, st.st_mtime, stat.S_IMODE(st.st_mode)]
+    return manifest
+
+
+def _clone_tree(source, dest, method, workers=None):
+    """Copy a tree of files with one of TemplateCache.create_files()'s
+    methods.
+
+    :return: The method used, see TemplateCache.create_files().
+    """
+    dirs = []
+    files = []
+    for dirpath, _, filenames in os.walk(source):
+        rel = os.path.relpath(dirpath, source)
+        target = os.path.normpath(os.path.join(dest, rel))
+        dirs.append((target, stat.S_IMODE(os.stat(dirpath).st_mode)))
+        files.extend((os.path.join(dirpath, name), os.path.join(target, name))
+                     for name in filenames)
+    for target, _ in dirs:
+        _mkdir(target, None)
+
+    def clone(item):
+        src, path = item
+        if method == 'hardlink':
+            try:
+                os.link(src, path)
+                return 'hardlink'
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    return None
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        return _copy_file(src, path, None, method in ('auto', 'reflink'))
+
+    used = set(_each(clone, files, workers)) - set([None])
+    # Modes last, in case they don't allow writing
+    for target, mode in reversed(dirs[1:]):
+        os.chmod(target, mode)
+    if 'copy' in used:
+        return 'copy'
+    if used:
+        return used.pop()
+    # No files (or they were all there already)
+    return 'reflink' if method == 'auto' else method
 
 
 class Node(object):
@@ -49,8 +419,8 @@ class Node(object):
 
         :param str path: A filesystem path.
         :param int type: One of Node.DIR, Node.FILE, or Node.ALTER.
-        :param str content: If given, type should be Node.FILE, and this will be
-            its content.
+        :param content: If given, type should be Node.FILE, and this will be
+            its content (str is encoded as UTF-8, bytes are written as is).
         :param int mode: (Octal) mode of the file or directory, e.g. 0777 or
             0644.
         :param str copyfrom: If given, type should be Node.FILE, and the content
@@ -66,6 +436,8 @@ class Node(object):
 
     @classmethod
     def from_dict(cls, item):
+        if isinstance(item, Node):
+            return item
         if isinstance(item, str):
             return cls(path=item, type=cls.DIR)
         else:
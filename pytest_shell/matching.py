@@ -0,0 +1,227 @@
+"""Incremental matchers used to know when to stop reading from a process.
+
+Each matcher is fed text as it's read and only looks at what's new (plus a
+small window carried over from before), reporting the exact offset in the
+stream where the match ended so anything after it can be kept for the next
+read.
+"""
+import re
+
+
+class SubstringMatcher(object):
+    """Matches a fixed string, e.g. a command terminator."""
+
+    def __init__(self, substring, count=1, line=False):
+        """
+
+        :param str substring: String to look for.
+        :param int count: Number of times it has to be seen.
+        :param bool line: Extend the match to the end of the line the string
+            is on, so the match isn't complete until the newline arrives.
+        """
+        self.substring = substring
+        self.count = count
+        self.line = line
+        self.reset()
+
+    def __call__(self, data):
+        """Check all of data at once, for use as a plain done_func."""
+        return data.count(self.substring) >= self.count
+
+    def reset(self):
+        """Forget anything fed so far."""
+        self._window = ''
+        self._offset = 0
+        self._seen = 0
+        self._found = None
+
+    def feed(self, text):
+        """Scan newly read text.
+
+        :param str text: Text read since the last call.
+        :return: Offset in everything fed so far where the match ends, or
+            None if there's no match yet.
+        :rtype: int
+        """
+        start = self._offset
+        window = self._window + text
+        if self._found is None:
+            pos = 0
+            while self._found is None:
+                i = window.find(self.substring, pos)
+                if i < 0:
+                    break
+                pos = i + len(self.substring)
+                self._seen += 1
+                if self._seen >= self.count:
+                    self._found = start + pos
+            if self._found is None:
+                # Keep just enough to catch the string split across reads,
+                # but nothing already counted
+                keep = max(pos, len(window) - len(self.substring) + 1)
+                self._window = window[keep:]
+                self._offset = start + keep
+                return None
+        if not self.line:
+            return self._found
+        i = window.find('\n', max(self._found - start, 0))
+        if i < 0:
+            self._window = ''
+            self._offset = start + len(window)
+            return None
+        return start + i + 1
+
+
+# Bits of a pattern that can match a newline
+_NEWLINE_TOKENS = ('\n', '\\n', '\\s', '\\S', '\\D', '\\W', '[^', '(?s',
+                   '\\x0a', '\\x0A', '\\012')
+
+
+def _can_span_lines(pattern):
+    """Whether a compiled regex might match across a newline (erring on the
+    side of yes).
+    """
+    if pattern.flags & re.S:
+        return True
+    source = pattern.pattern
+    if isinstance(source, bytes):
+        source = source.decode('latin-1')
+    return any(token in source for token in _NEWLINE_TOKENS)
+
+
+class RegexMatcher(object):
+    """Matches a compiled regular expression.
+
+    Scanning resumes from the start of the last incomplete line, so a match
+    can span several reads. Patterns that can match a newline (e.g. 'a\\nb',
+    '\\s' or re.S) rescan everything since the last match instead, so they can
+    match lines that arrived separately.
+    """
+
+    def __init__(self, pattern):
+        """
+
+        :param pattern: Compiled regular expression.
+        """
+        self.pattern = pattern
+        self.spans_lines = pattern is not None and _can_span_lines(pattern)
+        self.reset()
+
+    def __call__(self, data):
+        return self.pattern.search(data) is not None
+
+    def reset(self):
+        self._window = ''
+        self._offset = 0
+        #: The match object, once matched. Its positions are relative to
+        #: window_offset.
+        self.match = None
+        self.window_offset = 0
+
+    def feed(self, text):
+        """See SubstringMatcher.feed()."""
+        window = self._window + text
+        match = self._search(window)
+        if match is not None:
+            self.match = match
+            self.window_offset = self._offset
+            return self._offset + match.end()
+        keep = 0 if self.spans_lines else window.rfind('\n') + 1
+        self._window = window[keep:]
+        self._offset += keep
+        return None
+
+    def _search(self, window):
+        return self.pattern.search(window)
+
+
+class ExpectMatcher(RegexMatcher):
+    """Matches whichever of several regular expressions comes first, setting
+    index to say which. If several match at the same place the first in the
+    list wins.
+    """
+
+    def __init__(self, patterns):
+        """
+
+        :param list patterns: Compiled regular expressions.
+        """
+        self.patterns = list(patterns)
+        self.index = None
+        # One pass over the text with all of them, if they can be combined.
+        # Groups would be renumbered, breaking backreferences, so patterns
+        # with any are searched for separately.
+        combined = None
+        if (len(set(p.flags for p in self.patterns)) == 1 and
+                not any(p.groups for p in self.patterns)):
+            try:
+                combined = re.compile(
+                    '|'.join('(?:%s)' % p.pattern for p in self.patterns),
+                    self.patterns[0].flags)
+            except re.error:
+                pass
+        RegexMatcher.__init__(self, combined)
+        self.spans_lines = any(_can_span_lines(p) for p in self.patterns)
+
+    def __call__(self, data):
+        return any(p.search(data) is not None for p in self.patterns)
+
+    def reset(self):
+        RegexMatcher.reset(self)
+        self.index = None
+
+    def _search(self, window):
+        if self.pattern is not None:
+            match = self.pattern.search(window)
+            if match is None:
+                return None
+            for i, pattern in enumerate(self.patterns):
+                own = pattern.match(window, match.start())
+                if own is not None:
+                    self.index = i
+                    return own
+        # Each on its own, earliest match wins
+        found = None
+        for i, pattern in enumerate(self.patterns):
+            match = pattern.search(window)
+            if match is not None and (
+                    found is None or match.start() < found.start()):
+                found, self.index = match, i
+        return found
+
+
+class CallableMatcher(object):
+    """Adapts a function taking all output so far, which is called after
+    each line. This has to keep all of the output, so it's only for
+    compatibility with existing done_funcs.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.reset()
+
+    def __call__(self, data):
+        return self.func(data)
+
+    def reset(self):
+        self._text = ''
+
+    def feed(self, text):
+        """See SubstringMatcher.feed()."""
+        for line in text.splitlines(True):
+            self._text += line
+            if self.func(self._text):
+                return len(self._text)
+        return None
+
+
+def as_matcher(obj):
+    """Get a matcher for a matcher, compiled regex or function.
+
+    :rtype: SubstringMatcher or RegexMatcher or CallableMatcher
+    """
+    if hasattr(obj, 'feed'):
+        return obj
+    if hasattr(obj, 'search'):
+        return RegexMatcher(obj)
+    return CallableMatcher(obj)
@@ -0,0 +1,224 @@
+import threading
+import time
+
+import pytest
+
+from pytest_shell.connection import TimeOutError
+
+#: Counters kept by ShellPool, which are summed when merging stats from
+#: several pools (e.g. one per xdist worker).
+COUNTERS = ('hits', 'misses', 'discarded', 'resets', 'reset_time', 'spawns',
+            'spawn_time', 'checkouts', 'wait_time')
+
+
+class ShellPool(object):
+    """A pool of started shells that are put back to a clean state and reused
+    between tests, rather than starting a new process for every test.
+
+    It can be used from several threads, and warm() fills it in the
+    background, e.g. while tests are being collected.
+    """
+
+    def __init__(self, size, factory=None):
+        """
+
+        :param int size: Number of idle shells to keep around.
+        :param callable factory: Called with no arguments to create a new
+            (not yet started) session. Defaults to LocalBashSession.
+        """
+        if factory is None:
+            from pytest_shell.shell import LocalBashSession as factory
+        self.size = size
+        self.factory = factory
+        self._idle = []
+        self._baselines = {}
+        self._lock = threading.Condition()
+        self._warming = 0
+        self._warmer = None
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.resets = 0
+        self.reset_time = 0.0
+        self.spawns = 0
+        self.spawn_time = 0.0
+        self.checkouts = 0
+        self.wait_time = 0.0
+
+    def fill(self):
+        """Start shells until there are `size` of them idle."""
+        self._fill(self._reserve())
+
+    def warm(self):
+        """Fill the pool on a background thread."""
+        # Reserved now so checkout() waits for these rather than starting
+        # its own, however soon it's called
+        count = self._reserve()
+        self._warmer = threading.Thread(target=self._warm, args=(count,),
+                                        name='pytest-shell-pool')
+        self._warmer.daemon = True
+        self._warmer.start()
+
+    def _warm(self, count):
+        try:
+            self._fill(count)
+        except (TimeOutError, OSError, IOError, pytest.fail.Exception):
+            # Tests will start their own, and fail if that doesn't work
+            pass
+
+    def _reserve(self):
+        """Count shells as being started, to fill the pool."""
+        with self._lock:
+            count = max(self.size - len(self._idle) - self._warming, 0)
+            self._warming += count
+        return count
+
+    def _fill(self, count):
+        """Start shells reserved by _reserve()."""
+        while count:
+            session = None
+            try:
+                if not self._closed:
+                    session = self._spawn()
+            finally:
+                with self._lock:
+                    # If this failed, the rest are given up too
+                    done = count if session is None else 1
+                    self._warming -= done
+                    count -= done
+                    if session is not None:
+                        self._idle.append(session)
+                    self._lock.notify_all()
+
+    def _spawn(self):
+        started_at = time.time()
+        session = self.factory()
+        session.__enter__()
+        baseline = session.save_state()
+        with self._lock:
+            self._baselines[id(session)] = baseline
+            self.spawns += 1
+            self.spawn_time += time.time() - started_at
+        return session
+
+    def checkout(self):
+        """Get a started session, reusing an idle one if there is one or
+        waiting for one being started by warm().
+
+        :rtype: pytest_shell.shell.ShellSession
+        """
+        started_at = time.time()
+        try:
+            with self._lock:
+                self.checkouts += 1
+                while not self._idle and self._warming:
+                    self._lock.wait()
+                if self._idle:
+                    self.hits += 1
+                    return self._idle.pop()
+                self.misses += 1
+            return self._spawn()
+        finally:
+            with self._lock:
+                self.wait_time += time.time() - started_at
+
+    def checkin(self, session):
+        """Hand back a session from checkout(). It is reset and kept if the
+        pool has room for it and it is still usable, otherwise it's finished.
+        """
+        with self._lock:
+            full = self._closed or len(self._idle) >= self.size
+        if full:
+            self._finish(session)
+            return
+        started_at = time.time()
+        try:
+            ok = (session.connection.process.poll() is None
+                  and session.restore_state(self._baselines[id(session)]))
+        except (TimeOutError, OSError, IOError):
+            ok = False
+        with self._lock:
+            self.reset_time += time.time() - started_at
+            self.resets += 1
+            if not ok:
+                self.discarded += 1
+        if not ok:
+            self._finish(session)
+            return
+        session.connection.clear()
+        session.auto_return_code_error = True
+        session.last_return_code = 0
+        with self._lock:
+            self._idle.append(session)
+            self._lock.notify_all()
+
+    def close(self):
+        """Finish all idle shells, after waiting for warm() to stop."""
+        with self._lock:
+            self._closed = True
+        if self._warmer is not None:
+            self._warmer.join()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return
+                session = self._idle.pop()
+            self._finish(session)
+
+    def _finish(self, session):
+        with self._lock:
+            self._baselines.pop(id(session), None)
+        try:
+            session.__exit__(None, None, None)
+        except (OSError, IOError):
+            pass
+
+    def counters(self):
+        """The pool's counters, see COUNTERS.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((name, getattr(self, name)) for name in COUNTERS)
+
+    def stats(self):
+        """Summary of how the pool has been used, one line per stat.
+
+        :rtype: list[str]
+        """
+        return format_stats(self.counters())
+
+
+def merge_counters(total, counters):
+    """Add one pool's counters to a running total.
+
+    :param dict total: Counters to add to, changed in place.
+    :param dict counters: Counters from ShellPool.counters().
+    """
+    for name in COUNTERS:
+        total[name] = total.get(name, 0) + counters.get(name, 0)
+
+
+def format_stats(counters):
+    """Lines for the terminal summary from a pool's counters (or several
+    pools' added together).
+
+    :rtype: list[str]
+    """
+    def average(name, count):
+        return 1000 * counters[name] / count if count else 0
+
+    return [
+        'hits: %d, misses: %d, discarded: %d' % (
+            counters['hits'], counters['misses'], counters['discarded']),
+        'resets: %d, total reset time: %.2fs (%.1fms average)' % (
+            counters['resets'], counters['reset_time'],
+            average('reset_time', counters['resets'])),
+        'spawns: %d, total spawn time: %.2fs (%.1fms average)' % (
+            counters['spawns'], counters['spawn_time'],
+            average('spawn_time', counters['spawns'])),
+        'checkouts: %d, total wait time: %.2fs (%.1fms average)' % (
+            counters['checkouts'], counters['wait_time'],
+            average('wait_time', counters['checkouts'])),
+    ]
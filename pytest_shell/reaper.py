@@ -0,0 +1,256 @@
+"""Ending a shell's session and anything it left running in it.
+
+Each connection starts its process as the leader of a new session (so also
+a new process group), so background jobs, servers started with
+send_nowait() and the like can all be found and stopped when it's done.
+Only processes that start their own session (e.g. daemons) get away.
+Shells forked by a zygote (see pytest_shell.zygote) share its session, so
+each is the leader of a process group instead.
+"""
+import errno
+import os
+import signal
+import time
+
+
+def wait(process, timeout):
+    """Wait for a subprocess.Popen to exit.
+
+    :return: Whether it exited in time.
+    :rtype: bool
+    """
+    deadline = time.time() + timeout
+    # Most exit straight away, so start with short sleeps
+    delay = 0.0002
+    while process.poll() is None:
+        if time.time() >= deadline:
+            return False
+        time.sleep(delay)
+        delay = min(delay * 2, 0.005)
+    return True
+
+
+def session_processes(sid):
+    """Processes in a session, using /proc.
+
+    :param int sid: Session ID (the pid of its leader).
+    :return: pid and command line of each live (not zombie) process, or
+        None if /proc isn't available.
+    :rtype: list[(int, str)]
+    """
+    return _processes(sid, _SESSION)
+
+
+def group_processes(pgid):
+    """Processes in a process group, as for session_processes().
+
+    :param int pgid: Process group ID (the pid of its leader).
+    :rtype: list[(int, str)]
+    """
+    return _processes(pgid, _GROUP)
+
+
+def foreground_processes(pid):
+    """Processes a shell without job control is running in the foreground,
+    found as the rest of its process group that doesn't ignore SIGINT (which
+    such a shell sets up for background jobs). Nested shells running the
+    same command line as it are left out, as they're waiting for commands.
+
+    :param int pid: The shell, which leads its process group.
+    :return: pids, empty if /proc isn't available.
+    :rtype: list[int]
+    """
+    processes = group_processes(pid) or []
+    shell = dict(processes).get(pid)
+    return [found for found, cmdline in processes
+            if cmdline != shell and not _ignores(found, signal.SIGINT)]
+
+
+def send_signal(pids, sig):
+    """Send a signal to processes, ignoring any that have gone."""
+    _signal(None, pids, sig)
+
+
+def running(pid):
+    """Whether a process exists and isn't a zombie, e.g. one that isn't a
+    child of this process so can't be polled.
+
+    :rtype: bool
+    """
+    try:
+        with open('/proc/%d/stat' % pid, 'rb') as f:
+            return _stat_fields(f.read())[0] != b'Z'
+    except (IOError, OSError):
+        pass
+    if os.path.isdir('/proc/self'):
+        return False
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+# Positions in _stat_fields()
+_GROUP = 2
+_SESSION = 3
+
+
+def _stat_fields(stat):
+    # The command name is in brackets and can contain anything
+    return stat.rsplit(b')', 1)[1].split()
+
+
+def _processes(ident, field):
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return None
+    found = []
+    for pid in pids:
+        try:
+            with open('/proc/%d/stat' % pid, 'rb') as f:
+                fields = _stat_fields(f.read())
+            if int(fields[field]) != ident or fields[0] == b'Z':
+                continue
+            with open('/proc/%d/cmdline' % pid, 'rb') as f:
+                cmdline = f.read().rstrip(b'\0').replace(b'\0', b' ')
+        except (IOError, OSError, IndexError, ValueError):
+            # Gone already
+            continue
+        found.append((pid, cmdline.decode('utf8', 'replace')))
+    return found
+
+
+def _signal(pgid, pids, sig):
+    targets = [(os.kill, pid) for pid in pids]
+    if pgid is not None:
+        targets.insert(0, (os.killpg, pgid))
+    for kill, target in targets:
+        try:
+            kill(target, sig)
+        except OSError as e:
+            if e.errno not in (errno.ESRCH, errno.EPERM):
+                raise
+
+
+def _ignores(pid, sig):
+    try:
+        with open('/proc/%d/status' % pid, 'rb') as f:
+            for line in f:
+                if line.startswith(b'SigIgn:'):
+                    return bool(int(line.split()[1], 16) & 1 << (sig - 1))
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    return False
+
+
+def _alive(ident, field):
+    if field == _GROUP and not _group_exists(ident):
+        # Much quicker than looking through /proc. Sessions can have other
+        # groups in them, so need the full search.
+        return []
+    processes = _processes(ident, field)
+    if processes is not None:
+        return processes
+    # Without /proc, all that can be checked is the process group
+    try:
+        os.killpg(ident, 0)
+    except OSError:
+        return []
+    return [(None, '(process group %d)' % ident)]
+
+
+def _group_exists(pgid):
+    try:
+        os.killpg(pgid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def kill_session(sid, timeout=1.0, leader=None):
+    """Stop everything in a session, with SIGTERM and then SIGKILL if
+    they're still running after timeout.
+
+    Anything that was killed and has become a child of this process (e.g.
+    if it's PID 1 or a subreaper) is reaped, apart from leader.
+
+    :param int sid: Session ID.
+    :param float timeout: Time to wait after SIGTERM.
+    :param subprocess.Popen leader: The session leader, if it's still
+        around. It's reaped by whoever started it, and not counted as left
+        running.
+    :return: pid (None if unknown) and command line of each process other
+        than the leader that had to be killed.
+    :rtype: list[(int, str)]
+    """
+    return _kill(sid, _SESSION, timeout, leader)
+
+
+def kill_group(pgid, timeout=1.0, leader=None):
+    """Stop everything in a process group, as kill_session() does for a
+    session.
+
+    :param int pgid: Process group ID.
+    :param float timeout: Time to wait after SIGTERM.
+    :param leader: The group leader, if it's still around, as for
+        kill_session(). Anything with a poll() method will do.
+    :rtype: list[(int, str)]
+    """
+    return _kill(pgid, _GROUP, timeout, leader)
+
+
+def _kill(ident, field, timeout, leader):
+    processes = _alive(ident, field)
+    if not processes:
+        return []
+    leaked = [p for p in processes if p[0] != ident]
+    deadline = time.time() + timeout
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        _signal(ident, [pid for pid, _ in processes if pid is not None], sig)
+        while processes and time.time() < deadline:
+            time.sleep(0.005)
+            if leader is not None:
+                leader.poll()
+            processes = _alive(ident, field)
+        if not processes:
+            break
+        deadline = time.time() + timeout
+    for pid, _ in leaked:
+        if pid is None:
+            continue
+        try:
+            os.waitpid(pid, os.WNOHANG)
+        except OSError:
+            # Not ours
+            pass
+    return leaked
+
+
+class LeakedProcesses(object):
+    """Processes left running by shells and killed when they were finished,
+    for the terminal summary.
+    """
+
+    def __init__(self):
+        self.nodeid = None
+        self.entries = []
+
+    def __call__(self, command, leaked):
+        """Record processes left running by a connection, see
+        LocalConnection.leak_sink.
+        """
+        for pid, cmdline in leaked:
+            self.entries.append((self.nodeid, command, pid, cmdline))
+
+    def merge(self, entries):
+        """Add processes recorded elsewhere, e.g. by an xdist worker."""
+        self.entries.extend(tuple(entry) for entry in entries)
+
+    def lines(self):
+        """Lines for the terminal summary."""
+        for nodeid, command, pid, cmdline in self.entries:
+            yield '%s: killed %s (%s), left running by %s' % (
+                nodeid or '(no test)', pid if pid is not None else '?',
+                cmdline, command)
@@ -1,12 +1,23 @@
 from __future__ import print_function
 
+import codecs
+import collections
 import copy
+import errno
 import logging
+import mmap
+import os
+import pipes
+import stat
+import threading
+import time
 
 import pytest
 
-from pytest_shell.connection import local_bash_connection
+from pytest_shell.connection import TimeOutError, local_bash_connection
 from pytest_shell.dialect import BashDialect, Dialect
+from pytest_shell.snapshot import FsChanges
+from pytest_shell.zygote import ZygoteConnection
 
 
 class ShellSession(Dialect):
@@ -24,38 +35,63 @@ class ShellSession(Dialect):
         self._initial_source = list(source) if source else []
         self._initial_pwd = pwd
         self._depth = 0
+        self._inplace = False
+        self._saved_state = None
+        # Not copied for nested sessions, as they share the shell
+        self._shared = {}
         self.connection = connection
         self.auto_return_code_error = True
         self.last_return_code = 0
 
-    def __call__(self, envvars=None, source=None, pwd=None):
+    def __call__(self, envvars=None, source=None, pwd=None, inplace=False):
+        """Get a nested session, to use as a context manager.
+
+        :param dict envvars: Environment variables to set.
+        :param list source: Files to source.
+        :param str pwd: Directory to change to.
+        :param bool inplace: Rather than starting a subshell, save the state
+            of the current shell and put it back afterwards (see
+            checkpoint()). This is much quicker, but the shell isn't
+            isolated: exiting ends the whole session, background jobs keep
+            running and variables that aren't exported are still visible.
+        """
         obj = copy.copy(self)
         obj._initial_envvars = dict(envvars) if envvars else {}
         obj._initial_source = list(source) if source else []
         obj._initial_pwd = pwd
         obj._depth = self._depth + 1
+        obj._inplace = inplace
+        obj._saved_state = None
         return obj
 
     def __enter__(self):
         # This is pretty stupid, why would starting vs subshells be on different
         # objects?
         logger = logging.getLogger(__name__)
-        if self._depth > 0:
+        if self._depth > 0 and self._inplace:
+            self._saved_state = self.checkpoint()
+        elif self._depth > 0:
             self.start_subshell()
         else:
             self.connection.start()
-        if self._initial_pwd:
-            self.cd(self._initial_pwd)
         logger.debug('Setting vars: %s', self._initial_envvars)
-        for k, v in self._initial_envvars.items():
-            self.set_env(k, v)
-        for fname in self._initial_source:
-            self.source(fname)
+        failures = self.bootstrap(self._initial_pwd, self._initial_envvars,
+                                  self._initial_source)
+        if failures and self.auto_return_code_error:
+            for command, rc, out in failures:
+                print('Command:', command)
+                print('output:', out)
+            self.__exit__(None, None, None)
+            pytest.fail('Got non-zero return codes setting up the shell: %s' %
+                        ', '.join('"%s" (%d)' % (command, rc)
+                                  for command, rc, _ in failures))
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self._depth == 0:
             self.connection.finish()
+        elif self._inplace:
+            self.rollback(self._saved_state)
         else:
             self.exit()
 
@@ -92,6 +128,46 @@ class ShellSession(Dialect):
                         (self.last_return_code, command))
         return out
 
+    def send_many(self, commands):
+        """Run several commands in one round-trip, see
+        LocalConnection.send_many().
+
+        :return: Output of each command.
+        :rtype: list[str]
+        """
+        outs = self.connection.send_many(commands)
+        for command, out, rc in zip(commands, outs,
+                                    self.connection.last_return_codes):
+            self.last_return_code = rc
+            if rc and self.auto_return_code_error:
+                print('Command:', command)
+                print('stdout:', out)
+                print('stderr:', self.connection.stderr_output[command])
+                pytest.fail('Got non-zero return code %d when running "%s"' %
+                            (rc, command))
+        return outs
+
+    def send_stream(self, command):
+        """Run a command and yield its output a line at a time as it
+        arrives, see LocalConnection.send_stream().
+
+        The return code is checked once all output has been read.
+
+        :return: ('out', line) and ('err', line) tuples.
+        :rtype: iterator[(str, str)]
+        """
+        stream = self.connection.send_stream(command)
+        try:
+            for item in stream:
+                yield item
+        finally:
+            stream.close()
+        self.last_return_code = stream.return_code
+        if self.last_return_code and self.auto_return_code_error:
+            print('Command:', command)
+            pytest.fail('Got non-zero return code %d when running "%s"' %
+                        (self.last_return_code, command))
+
     def send_raw(self, command):
         self.connection.send_raw(command)
 
@@ -101,13 +177,276 @@ class ShellSession(Dialect):
     def wait_for(self, pattern_or_function, timeout=3.0):
         return self.connection.wait_for(pattern_or_function, timeout)
 
+    def expect(self, patterns, timeout=3.0):
+        """Wait for one of several patterns, see LocalConnection.expect()."""
+        return self.connection.expect(patterns, timeout)
+
 
 class LocalBashSession(ShellSession, BashDialect):
+    """Bash running locally.
 
-    def __init__(self, envvars=None, source=None, pwd=None, cmd='/bin/bash'):
-        ShellSession.__init__(self, local_bash_connection(cmd=cmd),
-                              envvars, source, pwd)
+    As the shell shares the filesystem with the tests, path_exists() and
+    file_contents() look at files directly rather than asking the shell,
+    which is only used to find its working directory when that might have
+    changed. This is only assumed for the default cmd, as others might run it
+    somewhere else (e.g. over ssh or in a container); set local_fs to say
+    otherwise.
+    """
 
+    def __init__(self, envvars=None, source=None, pwd=None, cmd='/bin/bash',
+                 zygote=None, local_fs=None, transcript=None):
+        """
 
-bash = LocalBashSession
+        :param dict envvars: Environment variables to set.
+        :param list source: Files to source.
+        :param str pwd: Directory to change to.
+        :param str cmd: Command to start bash.
+        :param pytest_shell.zygote.Zygote zygote: If given, the shell is
+            forked from this rather than started with cmd.
+        :param bool local_fs: Whether the shell sees the same filesystem as
+            the tests. By default, only if it's started with /bin/bash.
+        :param pytest_shell.transcript.Transcript transcript: Where to keep
+            the results of commands, e.g. to limit how many are kept. By
+            default they all are.
+        """
+        if zygote is not None:
+            connection = ZygoteConnection(zygote, transcript=transcript)
+            cmd = zygote.command
+        else:
+            connection = local_bash_connection(cmd=cmd, transcript=transcript)
+        ShellSession.__init__(self, connection, envvars, source, pwd)
+        self.local_fs = cmd == '/bin/bash' if local_fs is None else local_fs
+        self._cwd = None
+
+    @property
+    def cwd(self):
+        """The shell's working directory."""
+        generation = self.connection.generation
+        if self._cwd is None or self._cwd[0] != generation:
+            self._cwd = (generation, self.connection.send(
+                'printf %s "$PWD"', remember=False, readonly=True))
+        return self._cwd[1]
+
+    def cd(self, path):
+        # Only worth working out where we end up if we know where we are,
+        # otherwise it's left to cwd to ask when it's needed
+        cwd = None
+        if (self.local_fs and self._cwd is not None and
+                self._cwd[0] == self.connection.generation):
+            cwd = self._cwd[1]
+        BashDialect.cd(self, path)
+        # Work out where we are (as bash does without -P) rather than asking,
+        # unless it depends on CDPATH, ~ or the like.
+        if (cwd is not None and not self.connection.last_return_code and
+                pipes.quote(path) == path and
+                (path.startswith('/') or path.split('/')[0] in ('.', '..'))):
+            self._cwd = (self.connection.generation,
+                         os.path.normpath(os.path.join(cwd, path)))
+
+    def _local_path(self, path):
+        """Path to use locally for a path given to the shell, or None if it
+        needs the shell to interpret it (e.g. it has globs or variables).
+        """
+        if not self.local_fs or not path or pipes.quote(path) != path:
+            return None
+        if os.path.isabs(path):
+            return path
+        return os.path.join(self.cwd, path)
+
+    def path_exists(self, path):
+        local = self._local_path(path)
+        if local is None:
+            return BashDialect.path_exists(self, path)
+        try:
+            os.stat(local)
+        except OSError as e:
+            # stat(1) only says it doesn't exist for ENOENT
+            return e.errno != errno.ENOENT
+        return True
+
+    def file_contents(self, path):
+        view = self.file_view(path)
+        if view is None:
+            return BashDialect.file_contents(self, path)
+        try:
+            # Trailing whitespace is lost in the shell's output, so match that
+            return codecs.decode(view, self.connection.encoding,
+                                 self.connection.errors).rstrip()
+        finally:
+            view.release()
+
+    def file_view(self, path):
+        """Get the contents of a regular file without copying them, e.g. for
+        large artifacts.
+
+        :param str path: Path to the file, as the shell would see it. Only
+            plain paths are supported, without globs, variables or ~.
+        :return: Read-only memory mapping of the file, or None if it's not a
+            regular file or can't be read locally. Release it when done.
+        :rtype: memoryview
+        """
+        local = self._local_path(path)
+        if local is None:
+            return None
+        try:
+            with open(local, 'rb') as f:
+                if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                    return None
+                try:
+                    return memoryview(mmap.mmap(f.fileno(), 0,
+                                                access=mmap.ACCESS_READ))
+                except ValueError:
+                    # Empty files can't be mapped
+                    return memoryview(b'')
+        except (IOError, OSError):
+            return None
+
+    def fs_changes(self, root='.', contents=False, workers=1):
+        """Find what changes in a directory tree, e.g.::
+
+            with bash.fs_changes('build') as changes:
+                bash.run_script('./build.sh')
+            assert changes.added == ['app.tar.gz']
+
+        :param str root: Directory to look in, as the shell would see it.
+        :param bool contents: Compare files' contents rather than just their
+            sizes and modification times. Every file is read on entry.
+        :param int workers: Maximum number of threads to use, see
+            pytest_shell.snapshot.snapshot().
+        :rtype: pytest_shell.snapshot.FsChanges
+        """
+        local = self._local_path(root)
+        if local is None:
+            raise ValueError("Can't look at %r locally" % root)
+        return FsChanges(local, contents, workers)
+
+
+MemberResult = collections.namedtuple(
+    'MemberResult', ['session', 'output', 'stderr', 'return_code'])
 
+
+class ShellGroup(object):
+    """Runs the same commands on several sessions at once, so a command takes
+    as long as the slowest session rather than the total of all of them.
+
+    Each session needs its own connection, e.g.::
+
+        group = ShellGroup([LocalBashSession(envvars=e) for e in configs])
+        with group:
+            results = group.run_script('./deploy.sh')
+
+    As with ShellSession, the test fails if any session gets a non-zero return
+    code unless auto_return_code_error is False.
+    """
+
+    def __init__(self, sessions):
+        """
+
+        :param list[ShellSession] sessions: Sessions that haven't been
+            started yet.
+        """
+        self.sessions = list(sessions)
+        if len(set(id(s.connection) for s in self.sessions)) < len(
+                self.sessions):
+            raise ValueError('Each session needs its own connection')
+        self.auto_return_code_error = True
+
+    def __enter__(self):
+        errors = self._call(lambda s: s.__enter__(), self.sessions)[1]
+        if any(e is not None for e in errors):
+            # __exit__ won't be called, so finish the ones that did start
+            self._call(lambda s: s.__exit__(None, None, None),
+                       [s for s, e in zip(self.sessions, errors) if e is None])
+            raise next(e for e in errors if e is not None)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._run(lambda s: s.__exit__(exc_type, exc_val, exc_tb))
+
+    def send(self, command, timeout=10.0):
+        """Run a command on every session.
+
+        :param str command: Command to run.
+        :param float timeout: Maximum time for all sessions to finish.
+        :raises TimeOutError: If any session didn't finish in time.
+        :rtype: list[MemberResult]
+        """
+        return self._send_all(command, command, 'Command', timeout)
+
+    def run_script(self, path, args=None, timeout=10.0):
+        """Run a script on every session, see send()."""
+        return self._send_all(BashDialect.run_script_command(path, args),
+                              path, 'Script', timeout)
+
+    def _send_all(self, command, what, label, timeout):
+        results = self._run(
+            lambda s: s.connection.send(command, timeout=timeout,
+                                        soft_timeout=False),
+            timeout)
+        results = [
+            MemberResult(s, out, s.connection.last_stderr,
+                         s.connection.last_return_code)
+            for s, out in zip(self.sessions, results)]
+        failed = []
+        for i, result in enumerate(results):
+            result.session.last_return_code = result.return_code
+            if result.return_code:
+                failed.append(i)
+        if failed and self.auto_return_code_error:
+            for i in failed:
+                session, out, stderr, rc = results[i]
+                print('Session %d:' % i, 'envvars=%r, source=%r, pwd=%r' % (
+                    session._initial_envvars, session._initial_source,
+                    session._initial_pwd))
+                print('stdout:', out)
+                print('stderr:', stderr)
+            pytest.fail('Got non-zero return codes when running "%s" (%s)' % (
+                what, ', '.join('session %d: %d' % (i, results[i].return_code)
+                                for i in failed)))
+        return results
+
+    def _run(self, func, timeout=None):
+        """Call func with each session in its own thread.
+
+        :raises TimeOutError: If the threads aren't all finished within
+            timeout.
+        :return: What func returned for each session.
+        """
+        results, errors = self._call(func, self.sessions, timeout)
+        for error in errors:
+            if error is not None:
+                raise error
+        return results
+
+    @staticmethod
+    def _call(func, sessions, timeout=None):
+        """Like _run(), but for some of the sessions, and returns what func
+        raised for each (or None) rather than raising it.
+
+        :rtype: (list, list[BaseException])
+        """
+        results = [None] * len(sessions)
+        errors = [None] * len(sessions)
+
+        def run(i, session):
+            try:
+                results[i] = func(session)
+            except BaseException as e:
+                errors[i] = e
+
+        threads = [threading.Thread(target=run, args=(i, s))
+                   for i, s in enumerate(sessions)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in threads:
+            thread.join(None if deadline is None
+                        else max(0, deadline - time.time()))
+        for i, thread in enumerate(threads):
+            if thread.is_alive():
+                raise TimeOutError('Session %d did not finish in time' % i)
+        return results, errors
+
+
+bash = LocalBashSession
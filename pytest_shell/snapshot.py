@@ -0,0 +1,196 @@
+"""Snapshots of a directory tree, to find what a command changed."""
+import collections
+import errno
+import hashlib
+import os
+import stat
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    from scandir import scandir
+
+from pytest_shell.fs import _each
+
+#: Metadata for one path in a snapshot. digest is a hash of a regular file's
+#: contents or a symlink's target, or None if it wasn't worked out.
+FsEntry = collections.namedtuple(
+    'FsEntry', ['type', 'mode', 'size', 'mtime', 'ctime', 'ino', 'digest'])
+
+
+def snapshot(root, previous=None, contents=False, workers=1):
+    """Record the metadata of everything under a directory.
+
+    :param str root: Directory to look in. It isn't included itself.
+    :param dict previous: An earlier snapshot of the same tree. Digests are
+        copied from it for files whose size, times and inode are unchanged,
+        so only files that changed are read.
+    :param bool contents: Work out digests of files' contents, so files that
+        were written without changing are told apart from ones that changed.
+        This reads every file (unless previous has its digest), so it's off
+        by default.
+    :param int workers: Maximum number of threads to scan directories and
+        read files with (None for a default). This only pays off for large
+        files or slow filesystems, such as network mounts.
+    :return: FsEntry for each path, relative to root.
+    :rtype: dict
+    """
+    root = str(root)
+    entries = {}
+    files = []
+    level = ['']
+    while level:
+        found = _each(lambda rel: _scan(root, rel), level, workers)
+        level = []
+        for dir_entries in found:
+            for rel, entry in dir_entries:
+                if entry.type == stat.S_IFDIR:
+                    level.append(rel)
+                elif contents and entry.type in (stat.S_IFREG, stat.S_IFLNK):
+                    old = previous.get(rel) if previous else None
+                    if old is not None and old.digest is not None and \
+                            old[:-1] == entry[:-1]:
+                        entry = old
+                    else:
+                        files.append(rel)
+                entries[rel] = entry
+
+    digests = _each(lambda rel: _digest(os.path.join(root, rel),
+                                        entries[rel].type), files, workers)
+    for rel, digest in zip(files, digests):
+        entries[rel] = entries[rel]._replace(digest=digest)
+    return entries
+
+
+def _scan(root, rel):
+    """Entries in one directory, as (relative path, FsEntry) pairs."""
+    result = []
+    try:
+        it = scandir(os.path.join(root, rel) if rel else root)
+    except OSError as e:
+        # Removed or unreadable while we were looking
+        if e.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+            return result
+        raise
+    for dir_entry in it:
+        try:
+            st = dir_entry.stat(follow_symlinks=False)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                continue
+            raise
+        result.append((os.path.join(rel, dir_entry.name), FsEntry(
+            stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode), st.st_size,
+            st.st_mtime, st.st_ctime, st.st_ino, None)))
+    return result
+
+
+def _digest(path, type_):
+    try:
+        if type_ == stat.S_IFLNK:
+            return os.readlink(path)
+        # Only used to spot changes, so the fastest of the usual ones
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+def diff(before, after):
+    """Compare two snapshots of the same tree.
+
+    :rtype: FsDiff
+    """
+    result = FsDiff()
+    result.update(before, after)
+    return result
+
+
+class FsDiff(object):
+    """Paths that changed between two snapshots, each a sorted list of paths
+    relative to the root.
+
+    A path counts as modified if its contents (or a symlink's target, or the
+    type of thing it is) changed. Without digests, that's if a file's size
+    or modification time changed. Directories are never modified, but
+    what's in them is added or removed.
+    """
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+        self.mode_changed = []
+
+    def update(self, before, after):
+        """Set the differences between two snapshots.
+
+        :param dict before: Earlier snapshot.
+        :param dict after: Later snapshot.
+        """
+        self.added = sorted(set(after) - set(before))
+        self.removed = sorted(set(before) - set(after))
+        self.modified = []
+        self.mode_changed = []
+        for path in sorted(set(before) & set(after)):
+            old, new = before[path], after[path]
+            if old.mode != new.mode:
+                self.mode_changed.append(path)
+            if _modified(old, new):
+                self.modified.append(path)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified or
+                    self.mode_changed)
+
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return ('<FsDiff added=%r removed=%r modified=%r mode_changed=%r>' %
+                (self.added, self.removed, self.modified, self.mode_changed))
+
+
+def _modified(old, new):
+    if old.type != new.type:
+        return True
+    if old.type == stat.S_IFDIR:
+        return False
+    if old.digest is not None and new.digest is not None:
+        return old.digest != new.digest
+    return old.size != new.size or old.mtime != new.mtime
+
+
+class FsChanges(FsDiff):
+    """Context manager that snapshots a tree on entry and exit, and is then
+    the difference between them.
+
+    Usage::
+
+        with FsChanges('/tmp/work') as changes:
+            ...
+        assert changes.added == ['out.txt']
+    """
+
+    def __init__(self, root, contents=False, workers=1):
+        """
+        See snapshot() for parameters.
+        """
+        FsDiff.__init__(self)
+        self.root = str(root)
+        self.contents = contents
+        self.workers = workers
+        self.before = None
+        self.after = None
+
+    def __enter__(self):
+        self.before = snapshot(self.root, contents=self.contents,
+                               workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.after = snapshot(self.root, self.before, self.contents,
+                              self.workers)
+        self.update(self.before, self.after)
@@ -1 +1,6 @@
+import sys
+
 pytest_plugins = 'pytester'
+
+# async def needs 3.5, and the tests use asyncio.run() from 3.7
+collect_ignore = ['test_aio.py'] if sys.version_info < (3, 7) else []
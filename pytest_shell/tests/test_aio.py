@@ -0,0 +1,75 @@
+import asyncio
+import time
+
+import pytest
+
+from pytest_shell.aio import async_bash, async_local_bash_connection
+from pytest_shell.connection import TimeOutError
+
+
+def test_send():
+    async def go():
+        cn = async_local_bash_connection()
+        await cn.start()
+        assert await cn.send('echo blah') == 'blah'
+        await cn.send('echo err 1>&2; (exit 2)')
+        assert cn.last_stderr == 'err'
+        assert cn.last_return_code == 2
+        await cn.finish()
+    asyncio.run(go())
+
+
+def test_wait_for():
+    async def go():
+        cn = async_local_bash_connection()
+        await cn.start()
+        await cn.send_nowait('echo one; echo two')
+        await cn.wait_for('two')
+        await cn.send_nowait('sleep 0.5 && echo three')
+        with pytest.raises(TimeOutError):
+            await cn.wait_for('three', timeout=0.2)
+        await cn.finish()
+    asyncio.run(go())
+
+
+def test_expect():
+    async def go():
+        cn = async_local_bash_connection()
+        await cn.start()
+        await cn.send_nowait('echo one; echo ready')
+        result = await cn.expect(['error', 'ready'])
+        assert result.index == 1
+        assert result.before == 'one\n'
+        await cn.finish()
+    asyncio.run(go())
+
+
+def test_concurrent():
+    async def one(i):
+        async with async_bash(envvars={'NUM': str(i)}) as s:
+            assert (await s.envvars)['NUM'] == str(i)
+            return await s.send('sleep 0.5; echo $NUM')
+    async def go():
+        return await asyncio.gather(*[one(i) for i in range(10)])
+    started_at = time.time()
+    assert asyncio.run(go()) == [str(i) for i in range(10)]
+    assert time.time() - started_at < 3
+
+
+def test_session_helpers(tmpdir):
+    script = tmpdir.join('test.sh')
+    script.write('echo SUCCESS\n')
+    script.chmod(0o777)
+    async def go():
+        async with async_bash(pwd=tmpdir.strpath) as s:
+            assert await s.run_script(script) == 'SUCCESS'
+            assert await s.path_exists('test.sh')
+            assert not await s.path_exists('nothere.sh')
+            assert await s.file_contents('test.sh') == 'echo SUCCESS'
+            async with s(envvars={'INNER': 'yes'}) as inner:
+                assert (await inner.envvars)['INNER'] == 'yes'
+            assert 'INNER' not in await s.envvars
+            s.auto_return_code_error = False
+            await s.send('/bin/false')
+            assert s.last_return_code == 1
+    asyncio.run(go())
@@ -1,3 +1,5 @@
+import pytest
+
 from pytest_shell.connection import local_bash_connection
 
 
@@ -24,3 +26,194 @@ def test_last_stderr():
     cn.send('echo ZZZ 1>&2')
     assert cn.last_stderr == 'ZZZ'
 
+
+def test_send_latency():
+    import time
+    cn = local_bash_connection()
+    cn.start()
+    started_at = time.time()
+    for i in range(10):
+        assert cn.send('echo %d' % i) == str(i)
+    # Used to be at least 0.1s per command waiting on a sleep
+    assert time.time() - started_at < 0.5
+
+
+def test_return_code():
+    cn = local_bash_connection()
+    cn.start()
+    cn.send('(exit 3)')
+    assert cn.last_return_code == 3
+    # $? is left alone for the next command
+    assert cn.send('echo $?') == '3'
+    assert cn.last_return_code == 0
+    assert cn.send('printf blah') == 'blah'
+    # and nothing is left lying around in the shell
+    assert '__pytest_shell' not in cn.send('declare -p; declare -F')
+
+
+def test_start_is_quick():
+    import time
+    cn = local_bash_connection()
+    started_at = time.time()
+    cn.start()
+    assert time.time() - started_at < 0.5
+
+
+def test_start_drains_startup_output():
+    cn = local_bash_connection(
+        cmd=['/bin/bash', '-c', 'seq 1 5000; seq 1 500 1>&2; exec /bin/bash'])
+    cn.start()
+    assert cn.send('echo hi') == 'hi'
+    assert cn.last_stderr == ''
+
+
+def test_send_many():
+    cn = local_bash_connection()
+    cn.start()
+    cmds = ['echo a', 'echo b 1>&2; (exit 4)', 'printf c', 'echo $?']
+    assert cn.send_many(cmds) == ['a', 'b', 'c', '0']
+    assert cn.last_return_codes == [0, 4, 0, 0]
+    assert list(cn.stderr_output.values()) == ['', 'b', '', '']
+    assert list(cn.output.keys()) == cmds
+    assert cn.send('echo x') == 'x'
+    assert cn.send_many([]) == []
+    assert cn.last_return_codes == []
+
+
+def test_send_stream():
+    cn = local_bash_connection()
+    cn.start()
+    stream = cn.send_stream('seq 3; echo oops 1>&2; printf end; (exit 2)')
+    lines = list(stream)
+    assert [l for l in lines if l[0] == 'out'] == [
+        ('out', '1'), ('out', '2'), ('out', '3'), ('out', 'end')]
+    assert ('err', 'oops') in lines
+    assert stream.return_code == 2
+    assert cn.last_return_code == 2
+    assert cn.send('echo x') == 'x'
+
+
+@pytest.mark.parametrize('command', ['seq 100000', 'yes', 'tail -f /dev/null'])
+def test_send_stream_close(command):
+    import time
+    cn = local_bash_connection()
+    cn.start()
+    cn.send('sleep 100 &')
+    stream = cn.send_stream('echo started; ' + command)
+    assert next(stream) == ('out', 'started')
+    started_at = time.time()
+    stream.close()
+    assert time.time() - started_at < 2
+    assert stream.finished
+    assert cn.send('echo x') == 'x'
+    # Background jobs are left alone
+    assert cn.send('jobs -r | wc -l') == '1'
+    cn.send('kill %1; wait')
+    cn.finish()
+
+
+def test_large_output():
+    import time
+    cn = local_bash_connection()
+    cn.start()
+    started_at = time.time()
+    out = cn.send('seq 1 500000', timeout=30.0)
+    assert out.endswith('499999\n500000')
+    assert time.time() - started_at < 5.0
+
+
+def test_wait_for_keeps_rest_of_line():
+    cn = local_bash_connection()
+    cn.start()
+    cn.send_nowait('echo ready steady; echo go')
+    assert cn.wait_for('ready').endswith('ready')
+    assert 'go' in cn.wait_for('go')
+
+
+def test_wait_for_across_reads():
+    cn = local_bash_connection()
+    cn.start()
+    cn.send_nowait('echo foo; sleep 0.2; echo bar')
+    assert cn.wait_for('foo\nbar').endswith('foo\nbar')
+
+
+def test_wait_for_keeps_order():
+    import time
+    cn = local_bash_connection()
+    cn.start()
+    cn.send_nowait('echo MARK; seq 1 5000; echo END')
+    # Let it all be written, so the first read stops mid-way and there's
+    # more to read straight after the match
+    time.sleep(0.2)
+    assert cn.wait_for('MARK') == 'MARK'
+    rest = cn.wait_for('^END$')
+    assert rest.split() == [str(i) for i in range(1, 5001)] + ['END']
+
+
+def test_character_split_across_reads():
+    cn = local_bash_connection(encoding='utf-8')
+    cn.start()
+    # The first read is 4096 bytes, which ends half way through the é
+    out = cn.send("printf 'a%.0s' {1..4095}; printf '\\303\\251\\n'")
+    assert out == 'a' * 4095 + u'\xe9'
+
+
+def test_decode_errors():
+    cn = local_bash_connection(encoding='utf-8', errors='replace')
+    cn.start()
+    assert cn.send("printf 'a\\377b\\n'") == u'a\ufffdb'
+
+
+def test_expect():
+    cn = local_bash_connection()
+    cn.start()
+    cn.send_nowait("echo starting; echo 'password: ' ; echo ready")
+    result = cn.expect(['error', 'ready', r'password: '])
+    assert result.index == 2
+    assert result.match.group(0) == 'password: '
+    assert result.before.endswith('starting\n')
+    result = cn.expect(['error', 'ready'])
+    assert result.index == 1
+    assert result.before == '\n'
+
+
+def test_timings():
+    cn = local_bash_connection()
+    cn.start()
+    cn.send('sleep 0.2; echo done')
+    timings = cn.transcript.last.timings
+    assert set(timings) == {'write', 'first_byte', 'terminator', 'drain',
+                            'bytes', 'total'}
+    assert timings['first_byte'] >= 0.2
+    assert timings['bytes'] > len('done')
+    assert cn.last_timings is timings
+
+
+def test_finish_kills_leftovers():
+    import time
+    from pytest_shell.reaper import session_processes
+    conn = local_bash_connection()
+    conn.start()
+    # Including one with its own process group
+    conn.send('sleep 100 & set -m; sleep 101 &')
+    conn.send_nowait('sleep 102')
+    started_at = time.time()
+    leaked = conn.finish(timeout=0.2)
+    assert time.time() - started_at < 2
+    assert sorted(cmd for _, cmd in leaked) == [
+        'sleep 100', 'sleep 101', 'sleep 102']
+    assert conn.process.returncode is not None
+    assert session_processes(conn.process.pid) == []
+
+
+def test_start_without_ready_check():
+    import time
+    from pytest_shell.connection import (LocalConnection,
+                                         bash_command_terminator)
+    cn = LocalConnection(['cat'], bash_command_terminator)
+    started_at = time.time()
+    cn.start()
+    assert time.time() - started_at < 2
+    cn.send_raw('hello')
+    cn.wait_for('^hello$')
+    cn.finish()
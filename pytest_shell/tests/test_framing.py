@@ -0,0 +1,16 @@
+from pytest_shell.framing import LineFramer
+
+
+def test_split_lines():
+    framer = LineFramer('utf-8')
+    assert framer.feed(b'a\nb') == ['a\n']
+    assert framer.partial == 'b'
+    assert framer.feed(b'c\n\n') == ['bc\n', '\n']
+    assert framer.flush() == ''
+
+
+def test_split_character():
+    framer = LineFramer('utf-8')
+    data = u'é\n'.encode('utf-8')
+    assert framer.feed(data[:1]) == []
+    assert framer.feed(data[1:]) == [u'é\n']
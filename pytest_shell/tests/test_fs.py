@@ -57,3 +57,123 @@ def test_create_structure_copyfile(testdir):
             assert bash.send('md5sum /bin/bash').split()[0] == bash.send('md5sum %s' % tmpbash).split()[0]
     """)
     assert testdir.runpytest(capture='no').ret == 0
+
+
+def test_create_files(tmpdir):
+    import os
+    from pytest_shell.fs import create_files
+    tmpdir.join('existing.txt').write('old')
+    create_files([
+        'a/b',
+        {'a/b/c/text.txt': {'content': 'text', 'mode': 0o600}},
+        {'binary': {'content': b'\xff\x00'}},
+        {'empty': {'content': ''}},
+        {'existing.txt': {'content': 'new'}},
+        {'existing.txt': {'mode': 0o640}},
+    ], tmpdir)
+    assert tmpdir.join('a/b/c/text.txt').read() == 'text'
+    assert os.stat(str(tmpdir.join('a/b/c/text.txt'))).st_mode & 0o777 == 0o600
+    assert tmpdir.join('binary').read_binary() == b'\xff\x00'
+    assert tmpdir.join('empty').read() == ''
+    assert tmpdir.join('existing.txt').read() == 'old'
+    assert os.stat(str(tmpdir.join('existing.txt'))).st_mode & 0o777 == 0o640
+
+
+def test_create_files_parallel(tmpdir):
+    from pytest_shell.fs import PARALLEL_THRESHOLD, create_files
+    count = PARALLEL_THRESHOLD * 2
+    create_files({'d%d/f%d' % (i % 7, i): {'content': str(i)}
+                  for i in range(count)}, tmpdir)
+    assert tmpdir.join('d3/f10').read() == '10'
+    assert sum(len(d.listdir()) for d in tmpdir.listdir()) == count
+
+
+def test_create_files_copy_methods(tmpdir):
+    import os
+    from pytest_shell.fs import create_files
+    source = tmpdir.join('source')
+    source.write('data')
+    source.chmod(0o750)
+    create_files([{'hardlink': {'copyfrom': str(source)}},
+                  {'chmodded': {'copyfrom': str(source), 'mode': 0o600}}],
+                 tmpdir, copy_method='hardlink')
+    # Cloned where the filesystem supports it, copied where it doesn't
+    create_files([{'reflink': {'copyfrom': str(source)}}],
+                 tmpdir, copy_method='reflink')
+    assert os.stat(str(tmpdir.join('hardlink'))).st_ino == \
+        os.stat(str(source)).st_ino
+    assert os.stat(str(source)).st_mode & 0o777 == 0o750
+    assert tmpdir.join('chmodded').read() == 'data'
+    assert tmpdir.join('reflink').read() == 'data'
+    assert os.stat(str(tmpdir.join('reflink'))).st_ino != \
+        os.stat(str(source)).st_ino
+    assert os.stat(str(tmpdir.join('reflink'))).st_mode & 0o777 == 0o750
+
+
+def test_template_cache(tmpdir):
+    import os
+    from pytest_shell.fs import TemplateCache
+    source = tmpdir.join('source')
+    source.write('data')
+    structure = ['/etc', {'/etc/passwd': {'content': 'root:x:0:0'}},
+                 {'bin/tool': {'copyfrom': str(source), 'mode': 0o755}},
+                 {'/etc/passwd': {'mode': 0o600}}]
+    cache = TemplateCache(str(tmpdir.join('cache')))
+    for i in range(2):
+        root = tmpdir.join('root%d' % i)
+        # Only cloned where the filesystem supports it
+        used = cache.create_files(structure, root)
+        assert used in ('reflink', 'copy')
+        assert root.join('etc/passwd').read() == 'root:x:0:0'
+        assert os.stat(str(root.join('etc/passwd'))).st_mode & 0o777 == 0o600
+        assert os.stat(str(root.join('bin/tool'))).st_mode & 0o777 == 0o755
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.methods == {used: 2}
+    # Changing a copyfrom source means a new template
+    os.utime(str(source), (0, 0))
+    cache.create_files(structure, tmpdir.join('root2'))
+    assert cache.misses == 2
+
+
+def test_template_cache_hardlink(tmpdir):
+    import os
+    from pytest_shell.fs import TemplateCache
+    cache = TemplateCache()
+    structure = [{'file': {'content': 'original'}}]
+    assert cache.create_files(structure, tmpdir.join('one'),
+                              method='hardlink') == 'hardlink'
+    # Changed in place, so the template has to be rebuilt
+    tmpdir.join('one/file').write('changed')
+    cache.create_files(structure, tmpdir.join('two'), method='hardlink')
+    assert tmpdir.join('two/file').read() == 'original'
+    assert cache.misses == 2
+    # Rebuilt alongside the old one, which might still be being copied
+    assert sorted(os.listdir(cache.directory))[-1].endswith('-1')
+    assert len(os.listdir(cache.directory)) == 2
+    cache.close()
+
+
+def test_template_cache_hardlink_alter(tmpdir):
+    import os
+    from pytest_shell.fs import TemplateCache
+    cache = TemplateCache()
+    structure = [{'bin/tool': {'content': 'tool', 'mode': 0o755}}]
+    cache.create_files(structure + [{'bin/tool': {'mode': 0o700}}],
+                       tmpdir.join('one'), method='hardlink')
+    assert os.stat(str(tmpdir.join('one/bin/tool'))).st_mode & 0o777 == 0o700
+    cache.create_files(structure, tmpdir.join('two'), method='hardlink')
+    assert os.stat(str(tmpdir.join('two/bin/tool'))).st_mode & 0o777 == 0o755
+    assert cache.misses == 1
+    cache.close()
+
+
+def test_fs_templates_fixture(testdir):
+    testdir.makepyfile("""
+        def test_one(tmpdir, fs_templates):
+            fs_templates.create_files([{'a/b': {'content': 'x'}}], tmpdir)
+            assert tmpdir.join('a/b').read() == 'x'
+    """)
+    assert testdir.runpytest().ret == 0
+    assert testdir.runpytest().ret == 0
+    templates = testdir.tmpdir.join('.pytest_cache/d/pytest_shell_templates')
+    assert [t.basename[-2:] for t in templates.listdir()] == ['-0']
@@ -0,0 +1,64 @@
+import re
+
+from pytest_shell.matching import (CallableMatcher, ExpectMatcher,
+                                   RegexMatcher, SubstringMatcher, as_matcher)
+
+
+def test_substring_split_across_feeds():
+    matcher = SubstringMatcher('MARKER')
+    assert matcher.feed('abc MAR') is None
+    assert matcher.feed('KER def') == 10
+
+
+def test_substring_count_and_line():
+    matcher = SubstringMatcher('M', count=2, line=True)
+    assert matcher.feed('xM\nM') is None
+    assert matcher.feed(':0') is None
+    assert matcher.feed('\nrest') == 7
+
+
+def test_regex_resumes_at_incomplete_line():
+    matcher = RegexMatcher(re.compile('^ready$', re.M))
+    assert matcher.feed('one\nrea') is None
+    assert matcher.feed('dy\ntwo') == 9
+    assert matcher.match.group(0) == 'ready'
+
+
+def test_regex_across_lines_in_separate_reads():
+    matcher = RegexMatcher(re.compile('foo\nbar'))
+    assert matcher.spans_lines
+    assert matcher.feed('x\nfoo\n') is None
+    assert matcher.feed('bar\n') == 9
+    assert not RegexMatcher(re.compile('^ready$', re.M)).spans_lines
+
+
+def test_callable():
+    matcher = as_matcher(lambda data: 'b\n' in data)
+    assert isinstance(matcher, CallableMatcher)
+    assert matcher.feed('a\nb\nc\n') == 4
+
+
+def test_expect_first_match_wins():
+    matcher = ExpectMatcher([re.compile('b+'), re.compile('ab')])
+    assert matcher.pattern is not None
+    assert matcher.feed('xxab') == 4
+    assert matcher.index == 1
+    assert matcher.match.group(0) == 'ab'
+
+
+def test_expect_groups():
+    matcher = ExpectMatcher([re.compile(r'([ab])\1'), re.compile(r'(c)(\d)')])
+    assert matcher.pattern is None
+    assert matcher.feed('xabc1 aa') == 5
+    assert matcher.index == 1
+    assert matcher.match.groups() == ('c', '1')
+    matcher = ExpectMatcher([re.compile('c'), re.compile(r'(?P<x>a)(?P=x)')])
+    assert matcher.feed('xaab c') == 3
+    assert matcher.match.group('x') == 'a'
+
+
+def test_expect_uncombinable():
+    matcher = ExpectMatcher([re.compile('B', re.I), re.compile('a')])
+    assert matcher.pattern is None
+    assert matcher.feed('xba') == 2
+    assert matcher.index == 0
@@ -0,0 +1,149 @@
+from pytest_shell.pool import COUNTERS, ShellPool, format_stats, merge_counters
+
+
+def test_reuse():
+    pool = ShellPool(1)
+    pool.fill()
+    s = pool.checkout()
+    pid = s.connection.process.pid
+    pool.checkin(s)
+    s = pool.checkout()
+    assert s.connection.process.pid == pid
+    assert (pool.hits, pool.misses) == (2, 0)
+    pool.checkin(s)
+    pool.close()
+
+
+def test_reset():
+    pool = ShellPool(1)
+    s = pool.checkout()
+    cwd = s.send('pwd')
+    s.auto_return_code_error = False
+    s.send('export BLAH=1; cd /; f() { :; }; trap "echo x" USR1; '
+           'set -o noglob; sleep 100 &')
+    pool.checkin(s)
+    s = pool.checkout()
+    assert pool.misses == 1 and pool.hits == 1
+    assert 'BLAH' not in s.envvars
+    assert s.send('pwd') == cwd
+    assert s.send('declare -F; trap -p; jobs') == ''
+    assert s.send('set -o | grep noglob').split() == ['noglob', 'off']
+    assert s.auto_return_code_error
+    pool.close()
+
+
+def test_discard_dead_shell():
+    pool = ShellPool(1)
+    s = pool.checkout()
+    s.send_nowait('exit')
+    s.connection.process.wait()
+    pool.checkin(s)
+    assert pool.discarded == 1
+    assert not pool._idle
+
+
+def test_discard_busy_shell():
+    import time
+    pool = ShellPool(1)
+    s = pool.checkout()
+    s.send_nowait('sleep 100')
+    started_at = time.time()
+    pool.checkin(s)
+    assert time.time() - started_at < 2
+    assert pool.discarded == 1
+    assert not pool._idle
+
+
+def test_fixture(testdir):
+    testdir.makepyfile("""
+        def test_one(bash):
+            bash.send('export POOLED=1; cd /')
+
+        def test_two(bash):
+            assert 'POOLED' not in bash.envvars
+            assert bash.send('pwd') != '/'
+    """)
+    result = testdir.runpytest('--shell-pool-size=1')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*shell pool (size 1)*', 'hits: 2, misses: 0*'])
+
+
+def test_ini(testdir):
+    testdir.makeini("""
+        [pytest]
+        shell_pool_size = 2
+    """)
+    testdir.makepyfile("""
+        def test_one(bash):
+            pass
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 0
+    result.stdout.fnmatch_lines(['*shell pool (size 2)*'])
+
+
+def test_warm():
+    pool = ShellPool(3)
+    pool.warm()
+    sessions = [pool.checkout() for _ in range(4)]
+    counters = pool.counters()
+    assert (counters['hits'], counters['misses']) == (3, 1)
+    assert counters['spawns'] == counters['checkouts'] == 4
+    for s in sessions:
+        pool.checkin(s)
+    assert len(pool._idle) == 3
+    pool.close()
+    assert not pool._idle
+
+
+def test_merge_stats():
+    total = {}
+    merge_counters(total, dict((name, 1) for name in COUNTERS))
+    merge_counters(total, dict((name, 2) for name in COUNTERS))
+    assert total['hits'] == total['wait_time'] == 3
+    assert format_stats(total)[-1] == (
+        'checkouts: 3, total wait time: 3.00s (1000.0ms average)')
+
+
+def test_xdist_worker_stats(testdir):
+    # As sent back to the controller by each xdist worker
+    testdir.makeconftest("""
+        import pytest
+
+        class Node(object):
+            def __init__(self, config, hits):
+                self.config = config
+                self.workeroutput = {'pytest_shell': {
+                    'pool': {'hits': hits, 'spawns': 1, 'spawn_time': 0.5},
+                    'durations': [('test_a', 'sleep %d' % hits,
+                                   {'total': hits})],
+                }}
+
+        @pytest.hookimpl(tryfirst=True)
+        def pytest_configure(config):
+            config.option.dist = 'load'
+
+        def pytest_sessionfinish(session):
+            for hits in (2, 3):
+                session.config.hook.pytest_testnodedown(
+                    node=Node(session.config, hits), error=None)
+
+        def pytest_addhooks(pluginmanager):
+            class Hooks(object):
+                def pytest_testnodedown(self, node, error):
+                    pass
+            pluginmanager.add_hookspecs(Hooks)
+    """)
+    testdir.makepyfile("""
+        def test_nothing():
+            pass
+    """)
+    result = testdir.runpytest('--shell-pool-size=2', '--shell-durations=1')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*slowest 1 shell commands*',
+        '3.00s test_a: sleep 3',
+        '*shell pools (size 2, 2 workers)*',
+        'hits: 5, misses: 0, discarded: 0',
+        'spawns: 2, total spawn time: 1.00s (500.0ms average)',
+    ])
@@ -61,6 +61,32 @@ def test_env_var(testdir):
         assert s.envvars['TEST_VARIABLE'] == 'blahBLAH'
 
 
+def test_envvars_cached():
+    with bash() as s:
+        s.send("export MULTI=$'one\\ntwo'")
+        sent = len(s.connection.transcript)
+        assert s.envvars['MULTI'] == 'one\ntwo'
+        assert 'HOME' in s.envvars
+        s.envvars['MULTI'] = 'changed'
+        assert s.envvars['MULTI'] == 'one\ntwo'
+        assert len(s.connection.transcript) == sent + 1
+        s.send('export MULTI=three')
+        assert s.envvars['MULTI'] == 'three'
+
+
+def test_state(tmpdir):
+    with bash(pwd=tmpdir.strpath) as s:
+        s.auto_return_code_error = False
+        s.send('f() { :; }; set -u; export A=1; (exit 3)')
+        state = s.state()
+        assert state.cwd == tmpdir.strpath
+        assert state.return_code == 3
+        assert state.envvars['A'] == '1'
+        assert state.options['nounset'] and not state.options['xtrace']
+        assert state.functions == ['f']
+        assert s.send('echo $?') == '3'
+
+
 def test_source(tmpdir):
     """Test that sourcing a shell file loads it."""
     script = tmpdir.join('test.sh')
@@ -118,6 +144,37 @@ def test_context(testdir):
     assert result.ret == 0
 
 
+def test_context_inplace(tmpdir):
+    with bash() as b:
+        b.set_env('BLAH', 'SOMETHING')
+        pid = b.send('echo $BASHPID')
+        cwd = b.send('pwd')
+        with b(envvars={'BLAH2': 'SOMETHINGELSE'}, pwd=tmpdir.strpath,
+               inplace=True) as inner:
+            assert inner.send('echo $BASHPID') == pid
+            assert inner.envvars['BLAH2'] == 'SOMETHINGELSE'
+            assert inner.envvars['BLAH'] == 'SOMETHING'
+            assert inner.send('pwd') == tmpdir.strpath
+            inner.send("f() { :; }; set -o noglob; trap 'echo x' USR1")
+        assert 'BLAH2' not in b.envvars
+        assert b.send('pwd') == cwd
+        assert b.send('declare -F; trap -p') == ''
+        assert b.send('set -o | grep noglob').split() == ['noglob', 'off']
+
+
+def test_context_inplace_errexit():
+    with bash() as b:
+        b.send('KEEP=1')
+        with b(inplace=True) as inner:
+            # Putting KEEP back fails, which mustn't end the shell
+            inner.send('set -e; readonly KEEP')
+        assert b.send('echo $KEEP; [[ $- == *e* ]] || echo off') == '1\noff'
+        b.send('set -e')
+        with b(inplace=True) as inner:
+            inner.send('set +e')
+        assert b.send('[[ $- == *e* ]] && echo on') == 'on'
+
+
 def test_escaping(testdir):
     """Test that commands with quotes, escapes etc work correctly."""
     testdir.makepyfile(r"""
@@ -234,6 +291,91 @@ def test_path_exists(testdir):
     assert testdir.runpytest(capture='no').ret == 0
 
 
+def test_batched_probes(tmpdir):
+    tmpdir.join('file.txt').write('one\ntwo\n')
+    tmpdir.join('file.txt').chmod(0o640)
+    tmpdir.join('binary').write_binary(b'\xff\x00')
+    tmpdir.mkdir('dir')
+    paths = ['file.txt', 'dir', 'missing', "it's missing", 'binary']
+    with bash(pwd=tmpdir.strpath) as s:
+        sent = len(s.connection.transcript)
+        assert s.paths_exist(paths) == [True, True, False, False, True]
+        info = s.stat_many(paths)
+        assert [i.type for i in info] == [
+            'file', 'directory', None, None, 'file']
+        assert info[0].size == 8 and info[4].size == 2
+        assert info[0].mode == 0o640
+        assert s.file_contents_many(paths[:3]) == ['one\ntwo\n', None, None]
+        assert s.file_contents_many(['binary'], binary=True) == [b'\xff\x00']
+        assert len(s.connection.transcript) == sent + 4
+
+
+def test_local_fs(tmpdir):
+    tmpdir.mkdir('sub').join('big.bin').write_binary(b'\0' * 100000)
+    with bash(pwd=tmpdir.strpath) as s:
+        s.send('echo hello > out.txt')
+        assert s.cwd == tmpdir.strpath
+        sent = len(s.connection.transcript)
+        assert s.path_exists('out.txt')
+        assert not s.path_exists('missing.txt')
+        assert s.file_contents('out.txt') == 'hello'
+        s.cd('./sub')
+        view = s.file_view('big.bin')
+        assert len(view) == 100000 and view[-1:] == b'\0'
+        view.release()
+        assert len(s.connection.transcript) == sent + 1
+        # Anything the shell needs to interpret goes through it
+        assert s.path_exists('../out*')
+        s.send('cd ..')
+        assert s.file_view('sub') is None
+        # cd doesn't ask where it's starting from, and only works out where
+        # it ends up when it knew that
+        sent = []
+        s.connection.timings_sink = lambda command, timings: sent.append(
+            command)
+        s.send('true')
+        s.cd('./sub')
+        assert s.cwd == tmpdir.join('sub').strpath
+        s.cd('..')
+        assert s.cwd == tmpdir.strpath
+        assert sent == ['true', 'cd ./sub', 'printf %s "$PWD"', 'cd ..']
+        # Absolute paths don't need it at all
+        s.send('true')
+        assert s.file_contents(tmpdir.join('out.txt').strpath) == 'hello'
+        assert sent[-1] == 'true'
+        del s.connection.timings_sink
+        s.local_fs = False
+        assert s.file_contents('out.txt') == 'hello'
+
+
+def test_local_fs_custom_cmd(tmpdir):
+    tmpdir.join('here.txt').write('here')
+    # Could be ssh, docker exec or the like
+    cmd = ['/bin/bash', '--noprofile']
+    with bash(pwd=tmpdir.strpath, cmd=cmd) as s:
+        assert not s.local_fs
+        sent = []
+        s.connection.timings_sink = lambda command, timings: sent.append(
+            command)
+        assert s.file_contents('here.txt') == 'here'
+        assert sent == ['stat here.txt', 'cat here.txt']
+    with bash(pwd=tmpdir.strpath, cmd=cmd, local_fs=True) as s:
+        assert s.local_fs
+        assert s.file_contents('here.txt') == 'here'
+
+
+def test_fs_changes(tmpdir):
+    tmpdir.join('keep.txt').write('keep')
+    with bash(pwd=tmpdir.strpath) as s:
+        with s.fs_changes() as changes:
+            s.send('echo hello > out.txt; echo changed > keep.txt')
+        assert changes.added == ['out.txt']
+        assert changes.modified == ['keep.txt']
+        with s.fs_changes(contents=True) as changes:
+            s.send('touch keep.txt')
+        assert not changes
+
+
 def test_subshell(testdir):
     testdir.makepyfile("""
         def test_subshell(bash):
@@ -242,3 +384,146 @@ def test_subshell(testdir):
                     b.send('test')
                     assert not b.path_exists('/shouldntexist.txt')
     """)
+
+
+def test_send_many(testdir):
+    testdir.makepyfile("""
+        def test_send_many(bash):
+            assert bash.send_many(['echo one', 'echo two']) == ['one', 'two']
+            bash.send_many(['true', '/bin/false', 'true'])
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*non-zero return code 1*/bin/false*'])
+
+
+def test_send_stream(testdir):
+    testdir.makepyfile("""
+        def test_send_stream(bash):
+            lines = [line for _, line in bash.send_stream('seq 3')]
+            assert lines == ['1', '2', '3']
+            for _, line in bash.send_stream('yes'):
+                break
+            assert bash.send('echo after') == 'after'
+            list(bash.send_stream('echo before; (exit 3)'))
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 1
+    result.stdout.fnmatch_lines(['*non-zero return code 3*'])
+
+
+def test_durations(testdir):
+    testdir.makepyfile("""
+        def test_slow(bash):
+            bash.send('sleep 0.3')
+
+        def test_fast(bash):
+            bash.send('true')
+            bash.send('echo hi')
+    """)
+    result = testdir.runpytest('--shell-durations=2')
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*slowest 2 shell commands*',
+        '0.3*s test_durations.py::test_slow: sleep 0.3',
+        '*first byte*',
+        '*test_durations.py::test_fast: *',
+    ])
+    assert 'shell commands' not in testdir.runpytest().stdout.str()
+
+
+def test_group():
+    import time
+    from pytest_shell.shell import LocalBashSession, ShellGroup
+    group = ShellGroup([LocalBashSession(envvars={'NUM': str(i)})
+                        for i in range(5)])
+    with group:
+        started_at = time.time()
+        results = group.send('sleep 0.5; echo $NUM; echo err$NUM 1>&2')
+        assert time.time() - started_at < 1.5
+        for i, r in enumerate(results):
+            # stdout and stderr could come in either order
+            assert sorted(r.output.split('\n')) == [str(i), 'err%d' % i]
+        assert [r.stderr for r in results] == ['err%d' % i for i in range(5)]
+        assert [r.return_code for r in results] == [0] * 5
+
+
+def test_group_timeout():
+    from pytest_shell.connection import TimeOutError
+    from pytest_shell.shell import LocalBashSession, ShellGroup
+    with ShellGroup([LocalBashSession() for i in range(2)]) as group:
+        with pytest.raises(TimeOutError):
+            group.send('sleep 0.2; while true; do echo; sleep 0.01; done',
+                       timeout=0.5)
+
+
+def test_group_start_failure(tmpdir):
+    from pytest_shell.shell import LocalBashSession, ShellGroup
+    sessions = [LocalBashSession(),
+                LocalBashSession(source=[tmpdir.join('missing').strpath]),
+                LocalBashSession()]
+    with pytest.raises(pytest.fail.Exception):
+        with ShellGroup(sessions):
+            pass
+    assert all(s.connection.process.poll() is not None for s in sessions)
+
+
+def test_group_failure(testdir):
+    testdir.makepyfile("""
+        def test_group():
+            from pytest_shell.shell import LocalBashSession, ShellGroup
+            group = ShellGroup([LocalBashSession(envvars={'RC': str(i)})
+                                for i in range(3)])
+            with group:
+                group.send('(exit $RC)')
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 1
+    result.stdout.fnmatch_lines([
+        '*non-zero return codes when running "(exit $RC)" '
+        '(session 1: 1, session 2: 2)*'])
+
+
+def test_leaked_processes(testdir):
+    testdir.makepyfile("""
+        def test_server(bash):
+            bash.send_nowait('sleep 100')
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 0
+    result.stdout.fnmatch_lines([
+        '*shell processes left running (killed)*',
+        'test_leaked_processes.py::test_server: killed * (sleep 100), '
+        'left running by /bin/bash',
+    ])
+
+
+def test_bootstrap(testdir):
+    testdir.makefile('.sh', ok='echo sourced; OK=1',
+                     bad='echo about to fail; echo oops >&2; false')
+    testdir.makepyfile("""
+        import os
+
+        def test_ok(bash):
+            envvars = dict(('V%d' % i, str(i)) for i in range(30))
+            sent = len(bash.connection.transcript)
+            with bash(envvars=envvars, source=[os.path.abspath('ok.sh')],
+                      pwd='/') as b:
+                # One to start the subshell, one for the rest
+                assert len(b.connection.transcript) == sent + 2
+                assert b.send('echo $V29 $OK; pwd') == '29 1\\n/'
+
+        def test_bad(bash):
+            with bash(source=['ok.sh', 'bad.sh'], pwd='nonexistent'):
+                pass
+    """)
+    result = testdir.runpytest()
+    assert result.ret == 1
+    result.stdout.fnmatch_lines([
+        '*Got non-zero return codes setting up the shell: '
+        '"cd nonexistent" (1), "source bad.sh" (1)',
+        'Command: source bad.sh',
+        'output: about to fail',
+        'oops',
+        '*1 failed, 1 passed*',
+    ])
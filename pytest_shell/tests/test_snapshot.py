@@ -0,0 +1,58 @@
+import os
+
+from pytest_shell.snapshot import FsChanges, diff, snapshot
+
+
+def make_tree(tmpdir):
+    tmpdir.join('same.txt').write('same')
+    tmpdir.join('touched.txt').write('touched')
+    tmpdir.join('changed.txt').write('before')
+    tmpdir.join('gone.txt').write('gone')
+    tmpdir.join('mode.txt').write('mode')
+    tmpdir.mkdir('sub').join('deep.txt').write('deep')
+    tmpdir.join('link').mksymlinkto('same.txt')
+
+
+def change_tree(tmpdir):
+    os.utime(tmpdir.join('touched.txt').strpath, (0, 0))
+    tmpdir.join('changed.txt').write('after!')
+    tmpdir.join('gone.txt').remove()
+    tmpdir.join('mode.txt').chmod(0o600)
+    tmpdir.join('sub').join('new.txt').write('new')
+    tmpdir.join('link').remove()
+    tmpdir.join('link').mksymlinkto('touched.txt')
+
+
+def test_fs_changes(tmpdir):
+    make_tree(tmpdir)
+    with FsChanges(tmpdir, contents=True) as changes:
+        change_tree(tmpdir)
+    assert changes
+    assert changes.added == ['sub/new.txt']
+    assert changes.removed == ['gone.txt']
+    # Touching a file doesn't change what's in it
+    assert changes.modified == ['changed.txt', 'link']
+    assert changes.mode_changed == ['mode.txt']
+
+
+def test_fs_changes_without_contents(tmpdir):
+    make_tree(tmpdir)
+    with FsChanges(tmpdir, workers=None) as changes:
+        change_tree(tmpdir)
+    assert all(entry.digest is None for entry in changes.before.values())
+    assert changes.modified == ['changed.txt', 'link', 'touched.txt']
+    with FsChanges(tmpdir) as changes:
+        pass
+    assert not changes
+
+
+def test_snapshot_reuses_digests(tmpdir):
+    for i in range(100):
+        tmpdir.mkdir('d%d' % i).join('f').write(str(i))
+    before = snapshot(tmpdir, contents=True)
+    assert len(before) == 200
+    tmpdir.join('d5', 'f').write('changed')
+    after = snapshot(tmpdir, before, contents=True)
+    assert after['d1/f'] is before['d1/f']
+    assert after['d5/f'].digest != before['d5/f'].digest
+    assert diff(before, after).modified == ['d5/f']
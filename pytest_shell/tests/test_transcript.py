@@ -0,0 +1,108 @@
+from pytest_shell.connection import local_bash_connection
+from pytest_shell.transcript import CommandRecord, Transcript, TranscriptView
+
+
+def test_max_entries_spills():
+    t = Transcript(max_entries=2)
+    for i in range(5):
+        t.append(CommandRecord('echo %d' % i, str(i), '', 0))
+    assert [r.stdout for r in t] == ['3', '4']
+    assert [r.stdout for r in t.spilled()] == ['0', '1', '2']
+    assert t.last.stdout == '4'
+    # Still appends fine after reading back
+    t.append(CommandRecord('echo 5', '5', '', 0))
+    assert [r.stdout for r in t.spilled()] == ['0', '1', '2', '3']
+
+
+def test_max_bytes():
+    t = Transcript(max_bytes=20, spill=False)
+    t.append(CommandRecord('a', 'x' * 10, '', 0))
+    t.append(CommandRecord('b', 'y' * 10, '', 0))
+    assert [r.command for r in t] == ['b']
+    assert list(t.spilled()) == []
+
+
+def test_keeps_newest_and_last():
+    t = Transcript(max_bytes=5, spill=False)
+    t.append(CommandRecord('a', 'x' * 10, '', 0))
+    assert [r.command for r in t] == ['a']
+    assert t.last.command == 'a'
+    t = Transcript(max_entries=2, spill=False)
+    t.append(CommandRecord('echo hello', 'hello', '', 0))
+    t.append(CommandRecord('x', '', '', 0, remember=False))
+    t.append(CommandRecord('y', '', '', 0, remember=False))
+    assert [r.command for r in t] == ['x', 'y']
+    assert t.last_remembered.stdout == 'hello'
+
+
+def test_views():
+    t = Transcript()
+    t.append(CommandRecord('a', '1', 'e1', 0))
+    t.append(CommandRecord('b', '2', '', 0, remember=False))
+    t.append(CommandRecord('a', '3', 'e3', 1))
+    output = TranscriptView(t, 'stdout', remembered_only=True)
+    assert len(output) == 1
+    assert list(output) == ['a']
+    assert output.values() == ['3']
+    assert output['a'] == '3'
+    assert 'b' not in output
+    assert dict(output) == {'a': '3'}
+    assert TranscriptView(t, 'stderr')['a'] == 'e3'
+    debug = TranscriptView(t, 'stdout')
+    assert debug['b'] == '2'
+    assert debug.items() == [('a', '3'), ('b', '2')]
+    assert len(debug) == len(list(debug)) == 2
+    assert t.last_remembered.stdout == '3'
+
+
+def test_views_after_eviction():
+    t = Transcript(max_entries=2, spill=False)
+    t.append(CommandRecord('a', '1', '', 0))
+    t.append(CommandRecord('b', '2', '', 0))
+    t.append(CommandRecord('a', '3', '', 0))
+    output = TranscriptView(t, 'stdout')
+    assert output.items() == [('a', '3'), ('b', '2')]
+    t.append(CommandRecord('c', '4', '', 0))
+    assert output.items() == [('a', '3'), ('c', '4')]
+    t.clear()
+    assert len(output) == 0
+
+
+def test_connection_keeps_repeats():
+    cn = local_bash_connection(transcript=Transcript(max_entries=3))
+    cn.start()
+    for i in range(5):
+        cn.send('echo $((i++))' if i else 'i=1; echo 0')
+    assert cn.last == '4'
+    assert cn.output.values() == ['4']
+    assert [r.rc for r in cn.transcript] == [0, 0, 0]
+    assert len(list(cn.transcript.spilled())) == 2
+    cn.send('echo hello')
+    for i in range(3):
+        cn.send('true', remember=False)
+    assert cn.last == 'hello'
+
+
+
+def test_session_transcript():
+    from pytest_shell.shell import LocalBashSession
+    with LocalBashSession(transcript=Transcript(max_entries=1)) as b:
+        b.send('echo a')
+        b.send('echo b')
+        assert list(b.connection.output) == ['echo b']
+
+
+def test_plugin_retention(testdir):
+    testdir.makeini("""
+        [pytest]
+        shell_transcript_max_entries = 2
+    """)
+    testdir.makepyfile("""
+        def test_retention(bash):
+            for i in range(5):
+                bash.send('echo %d' % i)
+            assert len(bash.connection.transcript) == 2
+            assert bash.connection.transcript.max_entries == 2
+    """)
+    assert testdir.runpytest().ret == 0
+    assert testdir.runpytest('--shell-pool-size=1').ret == 0
@@ -0,0 +1,62 @@
+import pytest
+
+from pytest_shell.reaper import running
+from pytest_shell.shell import LocalBashSession
+from pytest_shell.zygote import Zygote
+
+
+@pytest.fixture
+def zygote(tmpdir):
+    lib = tmpdir.join('lib.sh')
+    lib.write('LIB_VAR=loaded\nlib_func() { echo "lib $1"; }\n')
+    z = Zygote(source=[lib.strpath])
+    yield z
+    z.close()
+
+
+def test_fork(zygote):
+    with LocalBashSession(zygote=zygote, envvars={'MINE': '1'}) as b:
+        assert b.send('lib_func x; echo $LIB_VAR $MINE') == 'lib x\nloaded 1'
+        assert b.send('echo $BASHPID') != zygote.session.send('echo $BASHPID')
+        assert b.send('cat <<EOF\nline 1\nline 2\nEOF') == 'line 1\nline 2'
+        b.auto_return_code_error = False
+        b.send('(exit 3)')
+        assert b.last_return_code == 3
+        assert b.send('echo $?') == '3'
+        b.auto_return_code_error = True
+        b.send('export ONLY_HERE=1')
+        with b(envvars={'NESTED': '1'}) as inner:
+            assert inner.send('echo $NESTED $ONLY_HERE') == '1 1'
+        b.send_nowait('read x; echo "got $x"')
+        b.send_raw('input')
+        b.wait_for('got input')
+    with LocalBashSession(zygote=zygote) as b:
+        assert b.send('echo ${ONLY_HERE-unset}') == 'unset'
+    assert zygote.forks == 2
+
+
+def test_finish_kills_group(zygote):
+    other = LocalBashSession(zygote=zygote)
+    with other:
+        with LocalBashSession(zygote=zygote) as b:
+            b.send('sleep 100 &')
+        assert [cmd for _, cmd in b.connection.leaked] == ['sleep 100']
+        assert not running(b.connection.process.pid)
+        assert other.send('echo still here') == 'still here'
+
+
+def test_plugin(testdir):
+    testdir.makefile('.sh', lib='lib_func() { echo "lib $1"; }')
+    testdir.makeini("""
+        [pytest]
+        shell_zygote_source = lib.sh
+    """)
+    testdir.makepyfile("""
+        def test_zygote(bash, shell_zygote):
+            assert bash.send('lib_func x') == 'lib x'
+            assert shell_zygote.forks == 1
+    """)
+    result = testdir.runpytest('--shell-zygote')
+    assert result.ret == 0
+    result = testdir.runpytest('--shell-zygote', '--shell-pool-size=1')
+    assert result.ret == 0
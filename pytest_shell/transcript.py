@@ -0,0 +1,198 @@
+import collections
+import json
+import tempfile
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+class CommandRecord(object):
+    """The result of one command sent on a connection."""
+
+    __slots__ = ('command', 'stdout', 'stderr', 'rc', 'timings', 'remember')
+
+    def __init__(self, command, stdout, stderr, rc=None, timings=None,
+                 remember=True):
+        """
+
+        :param str command: The command that was sent.
+        :param str stdout: Output of the command (including anything written
+            to stderr, where it happened).
+        :param str stderr: Just what the command wrote to stderr.
+        :param int rc: Return code, if known.
+        :param dict timings: Time taken by each stage of running the command,
+            in seconds.
+        :param bool remember: Whether the output is part of the connection's
+            `output`, rather than just its `debug_output`.
+        """
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.rc = rc
+        self.timings = timings or {}
+        self.remember = remember
+
+    def __len__(self):
+        """Rough size in characters, for retention limits."""
+        return len(self.command) + len(self.stdout) + len(self.stderr)
+
+    def __repr__(self):
+        return 'CommandRecord(%r, rc=%r)' % (self.command, self.rc)
+
+    def to_list(self):
+        return [self.command, self.stdout, self.stderr, self.rc, self.timings,
+                self.remember]
+
+
+class Transcript(object):
+    """Record of the commands run on a connection, oldest first.
+
+    Retention can be limited by the number of records and/or their total
+    size; once over the limit the oldest records are dropped, after being
+    written to a temporary file if spill is True. The newest record is
+    always kept, and last and last_remembered are kept however old they are.
+
+    The latest record in memory for each command is indexed, for
+    TranscriptView.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, spill=True):
+        """
+
+        :param int max_entries: Maximum number of records to keep in memory.
+        :param int max_bytes: Maximum total size (see CommandRecord.__len__)
+            of records to keep in memory.
+        :param bool spill: Write dropped records to a temporary file so they
+            can still be read with spilled().
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self._records = collections.deque()
+        self._size = 0
+        self._spill_file = None
+        # Latest record for each command, in the order each was first sent
+        self._latest = collections.OrderedDict()
+        self._latest_remembered = collections.OrderedDict()
+        self.last = None
+        self.last_remembered = None
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def latest(self, remembered_only=False):
+        """The latest record in memory for each command.
+
+        :param bool remembered_only: Only look at records with remember set.
+        :return: Records by command, in the order each command was first
+            sent. Don't change it.
+        :rtype: collections.OrderedDict
+        """
+        if remembered_only:
+            return self._latest_remembered
+        return self._latest
+
+    def append(self, record):
+        """Add a record, dropping old ones if over the retention limits.
+
+        :param CommandRecord record: The record to add.
+        """
+        self._records.append(record)
+        self._size += len(record)
+        self._latest[record.command] = record
+        self.last = record
+        if record.remember:
+            self._latest_remembered[record.command] = record
+            self.last_remembered = record
+        # The newest is always kept, however big it is
+        while len(self._records) > 1 and (
+                (self.max_entries is not None
+                 and len(self._records) > self.max_entries) or
+                (self.max_bytes is not None and self._size > self.max_bytes)):
+            self._evict()
+
+    def _evict(self):
+        record = self._records.popleft()
+        self._size -= len(record)
+        # As the oldest, it's only the latest if it's the only one
+        for latest in (self._latest, self._latest_remembered):
+            if latest.get(record.command) is record:
+                del latest[record.command]
+        # last and last_remembered stay, even if they're no longer in memory
+        if self.spill:
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile(mode='w+')
+            self._spill_file.write(json.dumps(record.to_list()) + '\n')
+
+    def spilled(self):
+        """Records dropped from memory so far, oldest first.
+
+        :rtype: iterator[CommandRecord]
+        """
+        if self._spill_file is None:
+            return
+        self._spill_file.flush()
+        self._spill_file.seek(0)
+        try:
+            for line in self._spill_file:
+                yield CommandRecord(*json.loads(line))
+        finally:
+            self._spill_file.seek(0, 2)
+
+    def clear(self):
+        """Forget all records, including any spilled ones."""
+        self._records.clear()
+        self._size = 0
+        self._latest.clear()
+        self._latest_remembered.clear()
+        self.last = self.last_remembered = None
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+
+class TranscriptView(Mapping):
+    """Read-only mapping of command to one field of its latest record, e.g.
+    for LocalConnection.output. Commands are in the order they were first
+    sent.
+    """
+
+    def __init__(self, transcript, field, remembered_only=False):
+        """
+
+        :param Transcript transcript: Records to look at.
+        :param str field: CommandRecord attribute to give as the value.
+        :param bool remembered_only: Only include records with remember set.
+        """
+        self.transcript = transcript
+        self.field = field
+        self.remembered_only = remembered_only
+
+    def __len__(self):
+        return len(self.transcript.latest(self.remembered_only))
+
+    def __iter__(self):
+        return iter(self.transcript.latest(self.remembered_only))
+
+    def __getitem__(self, command):
+        return getattr(self.transcript.latest(self.remembered_only)[command],
+                       self.field)
+
+    def __contains__(self, command):
+        return command in self.transcript.latest(self.remembered_only)
+
+    def values(self):
+        return [getattr(record, self.field) for record in
+                self.transcript.latest(self.remembered_only).values()]
+
+    def items(self):
+        return [(command, getattr(record, self.field)) for command, record in
+                self.transcript.latest(self.remembered_only).items()]
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.items())
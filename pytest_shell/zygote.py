@@ -0,0 +1,269 @@
+"""Starting shells by forking one that's already been set up.
+
+A Zygote is a bash that's started once, sources whatever's needed and then
+forks a child for each new session, connected to the tests by FIFOs. The
+child has everything the zygote had (variables, functions, options and so
+on) without starting bash or sourcing anything again.
+
+A forked child can't go back to reading commands the way bash does, so it
+runs a small loop that reads each command and evals it. Each write to its
+stdin is framed by a "#<length>" line, which is a comment to anything else
+reading the same stdin (e.g. a nested bash), so commands can span several
+lines.
+"""
+import errno
+import fcntl
+import io
+import os
+import pipes
+import shutil
+import tempfile
+import threading
+import time
+
+from pytest_shell import reaper
+from pytest_shell.connection import (LocalConnection, TimeOutError,
+                                     bash_command_terminator,
+                                     bash_ready_check)
+
+# Run by each child. $? is put back before each command (without forking
+# for the usual 0) as the reads in between would otherwise reset it, and
+# the && keeps that out of the way of errexit and ERR traps.
+_LOOP = r'''__pytest_shell_status=0
+while IFS= read -r __pytest_shell_line; do
+    case $__pytest_shell_line in
+        \#[0-9]*) LC_ALL=C IFS= read -r -N "${__pytest_shell_line#\#}" \
+            __pytest_shell_line ;;
+    esac
+    if [ "$__pytest_shell_status" != 0 ]; then
+        __pytest_shell_ret() { unset -f __pytest_shell_ret; return "$1"; }
+        __pytest_shell_ret "$__pytest_shell_status" && :
+    fi
+    eval "$__pytest_shell_line"
+    __pytest_shell_status=$?
+done
+exit "$__pytest_shell_status"'''
+
+# Run by the zygote for each child. Job control puts the child in its own
+# process group, which is what's killed when it's finished. stdout and
+# stderr are opened before stdin, see Zygote.fork().
+_FORK = ('{ set +m; exec >%s 2>%s <%s; eval "$__pytest_shell_loop"; } & '
+         'printf \'%%s\\n\' "$!"; disown')
+
+
+class Zygote(object):
+    """A shell that's set up once and forked to start each session.
+
+    Sessions forked from it start with its state, but otherwise behave as
+    if they'd been started separately, with a few differences: $$ is the
+    zygote's pid, `break` and `continue` outside a loop end the session,
+    `set -x` also traces the loop that runs commands, and anything a session
+    leaves running in a process group of its own is only stopped when the
+    zygote is closed.
+
+    It's started on the first fork(), and can be used from several threads.
+    """
+
+    def __init__(self, envvars=None, source=None, pwd=None, cmd='/bin/bash'):
+        """
+
+        :param dict envvars: Environment variables to set in the zygote.
+        :param list source: Files to source in the zygote.
+        :param str pwd: Directory to change to.
+        :param str cmd: Command to start the zygote.
+        """
+        from pytest_shell.shell import LocalBashSession
+        self.command = cmd
+        self.session = LocalBashSession(envvars, source, pwd, cmd)
+        self.forks = 0
+        self.fork_time = 0.0
+        self._lock = threading.Lock()
+        self._started = False
+
+    @property
+    def running(self):
+        return self._started
+
+    def start(self):
+        """Start the zygote, if it isn't already."""
+        with self._lock:
+            self._start()
+
+    def _start(self):
+        if self._started:
+            return
+        # If this fails (e.g. a file doesn't source) the next fork tries
+        # again, so each test reports it
+        self.session.__enter__()
+        self.session.send('set -m; __pytest_shell_loop=%s' %
+                          pipes.quote(_LOOP))
+        self._started = True
+
+    def fork(self, timeout=10.0):
+        """Start a child shell.
+
+        :param float timeout: Maximum time to wait for it to start.
+        :raises TimeOutError:
+        :rtype: ZygoteProcess
+        """
+        started_at = time.time()
+        tmpdir = tempfile.mkdtemp(prefix='pytest-shell-')
+        fds = []
+        try:
+            paths = [os.path.join(tmpdir, name)
+                     for name in ('in', 'out', 'err')]
+            for path in paths:
+                os.mkfifo(path, 0o600)
+            # Opening these doesn't wait for the child, and once they're
+            # open the child doesn't wait for them either
+            for path in paths[1:]:
+                fds.append(os.open(path, os.O_RDONLY | os.O_NONBLOCK))
+            with self._lock:
+                self._start()
+                connection = self.session.connection
+                pid = int(connection.send(
+                    _FORK % tuple(pipes.quote(path) for path in paths[1:] +
+                                  paths[:1]), remember=False))
+                # Only the pid was wanted, not a record of every fork
+                connection.clear()
+            try:
+                fds.insert(0, _open_writer(paths[0], pid,
+                                           started_at + timeout))
+            except (TimeOutError, OSError):
+                reaper.kill_group(pid, timeout=0.1)
+                raise
+        except BaseException:
+            for fd in fds:
+                os.close(fd)
+            raise
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        with self._lock:
+            self.forks += 1
+            self.fork_time += time.time() - started_at
+        return ZygoteProcess(pid, *fds)
+
+    def close(self):
+        """Finish the zygote, and anything forked from it that's still
+        running.
+        """
+        with self._lock:
+            if self._started:
+                self._started = False
+                self.session.__exit__(None, None, None)
+
+
+def _open_writer(path, pid, deadline):
+    """Open the write end of a FIFO once the child has opened the other.
+
+    :raises TimeOutError:
+    :return: File descriptor, in blocking mode.
+    :rtype: int
+    """
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            # ENXIO until there's a reader
+            if e.errno != errno.ENXIO:
+                raise
+        if not reaper.running(pid):
+            raise OSError(errno.ESRCH, 'forked shell exited', path)
+        if time.time() >= deadline:
+            raise TimeOutError()
+        time.sleep(0.0001)
+    fcntl.fcntl(fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return fd
+
+
+class ZygoteProcess(object):
+    """A shell forked by a Zygote, with as much of subprocess.Popen as
+    LocalConnection needs.
+
+    As the zygote reaps it rather than this process, its exit status isn't
+    known and returncode is 0 once it's gone.
+    """
+
+    def __init__(self, pid, stdin, stdout, stderr):
+        """
+
+        :param int pid: Its pid, and process group.
+        :param int stdin: File descriptors connected to it.
+        :param int stdout:
+        :param int stderr:
+        """
+        self.pid = pid
+        self.stdin = FramedWriter(stdin)
+        self.stdout = io.FileIO(stdout, 'r')
+        self.stderr = io.FileIO(stderr, 'r')
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None and not reaper.running(self.pid):
+            self.returncode = 0
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if timeout is not None and not reaper.wait(self, timeout):
+            raise TimeOutError()
+        while self.poll() is None:
+            time.sleep(0.005)
+        return self.returncode
+
+
+class FramedWriter(object):
+    """stdin of a forked shell. Each write is framed so the shell reads it
+    as one command, see _LOOP.
+    """
+
+    def __init__(self, fd):
+        self._file = io.FileIO(fd, 'w')
+
+    def write(self, data):
+        """Write a command, or several."""
+        return self._file.write(('#%d\n' % len(data)).encode('ascii') + data)
+
+    def write_raw(self, data):
+        """Write data as is, e.g. input for a running command."""
+        return self._file.write(data)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+
+class ZygoteConnection(LocalConnection):
+    """A connection to a shell forked from a Zygote."""
+
+    def __init__(self, zygote, encoding=None, transcript=None,
+                 errors='strict'):
+        """
+
+        :param Zygote zygote: Zygote to fork the shell from.
+        :param str encoding: As for LocalConnection.
+        :param Transcript transcript:
+        :param str errors:
+        """
+        LocalConnection.__init__(self, zygote.command,
+                                 bash_command_terminator, encoding=encoding,
+                                 transcript=transcript, errors=errors,
+                                 ready=bash_ready_check)
+        self.zygote = zygote
+
+    def _spawn(self, timeout):
+        return self.zygote.fork(timeout)
+
+    def _kill_leftovers(self, timeout):
+        # The child shares the zygote's session, but has its own group
+        return reaper.kill_group(self.process.pid, timeout,
+                                 leader=self.process)
+
+    def send_raw(self, text):
+        self.generation += 1
+        cmd = text + '\n'
+        self.logger.info('In raw: %s', repr(cmd))
+        self.process.stdin.write_raw(cmd.encode(self.encoding))
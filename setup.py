@@ -25,7 +25,8 @@ setup(
     long_description=read('README.rst'),
     packages=find_packages(),
     python_requires='>=2.7, !=3.0.*, !=3.1.*, !=3.2.*, !=3.3.*',
-    install_requires=['pytest>=3.5.0'],
+    install_requires=['pytest>=3.5.0', 'futures; python_version<"3"',
+                      'scandir; python_version<"3.5"'],
     classifiers=[
         'Development Status :: 4 - Beta',
         'Framework :: Pytest',